@@ -3,36 +3,34 @@
 import sys
 import struct
 import itertools
+import array
 import glob
 import os
+import argparse
+import threading
+import collections
+import multiprocessing.pool
 
 import yaml
-from mp4file.mp4file import Mp4File
-
-def get_hmmt_data(parent):
-    retval = None
-    for atom in parent.get_atoms():
-        if atom.name == "HMMT":
-
-            # Read the HMMT payload from the open file, taking care to save
-            # and reset the current offset of the file in case the Mp4File
-            # object is making assumptions about its offset into the file.
-            save_offset = parent.file.tell()
-            parent.file.seek(atom.offset)
-            hmmt_bytes = parent.file.read(atom.size)
-            parent.file.seek(save_offset)
-            
-            # The offset seems to be imprecise, so we need to search for
-            # the actual HMMT marker and take the data beyond that.
-            hmmt_index = hmmt_bytes.find("HMMT")
-            if hmmt_index != -1:
-                return hmmt_bytes[hmmt_index + 4:]
-    
-        # The MP4 atom structure is a tree, recurse to visit all nodes.
-        retval = get_hmmt_data(atom)
 
-        if retval is not None:
-            return retval
+import mp4box
+import metacache
+import matching
+import audiosync
+import gpslog
+import laps
+import profiling
+import proxies
+import sessionstore
+import telemetry
+
+# GoPro cameras store HiLight tags in a HMMT box within the user data box.
+HMMT_BOX_PATH = ["moov", "udta", "HMMT"]
+
+def get_hmmt_data(path, use_mmap=False):
+    # Seek straight to the HMMT box using the box headers instead of parsing
+    # the whole atom tree, which is slow on multi-gigabyte files.
+    return mp4box.read_box_payload(path, HMMT_BOX_PATH, use_mmap)
 
 def get_tags(hmmt_data):
     if hmmt_data is None:
@@ -57,15 +55,107 @@ def make_signature(tags):
     signature = [tag - offset for tag in tags[1:]]
     return signature
 
-segments = []
+def get_metadata(path):
+    """Extract everything we need to know about a video file into a plain
+    dict, suitable for caching."""
+    profiling.count("files_read")
+    with profiling.stage("tag_extraction"):
+        tags = get_tags(get_hmmt_data(path))
+    metadata = {
+        "tags": tags,
+        "signature": make_signature(tags),
+        "duration": None,
+        "fps": None,
+        "creation_time": None,
+    }
+
+    with profiling.stage("video_probe"):
+        try:
+            details = mp4box.probe_video(path)
+        except (IOError, struct.error):
+            # Corrupt or not fully copied, so the tags are all that's known.
+            details = None
+    if details is not None:
+        metadata['duration'] = details['duration']
+        metadata['fps'] = details['fps']
+        metadata['creation_time'] = details['creation_time']
+
+    return metadata
+
+def interleave_by_device(paths):
+    """Reorder paths so that consecutive paths are on different devices where
+    possible, which keeps every device busy when they're handed out to a pool
+    of workers in order."""
+    by_device = collections.OrderedDict()
+    for path in paths:
+        by_device.setdefault(os.stat(path).st_dev, []).append(path)
+
+    interleaved = []
+    for group in itertools.izip_longest(*by_device.values()):
+        interleaved.extend(path for path in group if path is not None)
+    return interleaved
+
+def extract_metadata(paths, jobs=1, jobs_per_device=1):
+    """Extract metadata from each of paths, yielding (path, metadata) tuples
+    in no particular order. Up to jobs files are read at once, with no more
+    than jobs_per_device of those from the same device, because several
+    readers competing for one SD card reader are slower than one."""
+    if jobs <= 1:
+        for path in paths:
+            yield (path, get_metadata(path))
+        return
+
+    # st_dev identifies the filesystem, which is the closest thing we have to
+    # the physical device (card reader) the file lives on.
+    semaphores = {}
+    for path in paths:
+        device = os.stat(path).st_dev
+        if device not in semaphores:
+            semaphores[device] = threading.BoundedSemaphore(jobs_per_device)
+
+    def worker(path):
+        with semaphores[os.stat(path).st_dev]:
+            return (path, get_metadata(path))
+
+    # Metadata extraction spends most of its time waiting on I/O, so threads
+    # are sufficient and avoid pickling anything between processes.
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(worker, interleave_by_device(paths)):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+# Matches lining up fewer than this fraction of tags are ignored.
+MIN_MATCH_CONFIDENCE = 0.5
 
 class Segment(object):
-    def __init__(self, path, camera):
+    # There can be a great many segments in a large archive, so avoid a
+    # per-instance dict.
+    __slots__ = ["path", "camera", "filename", "tags", "signature",
+        "duration", "fps", "creation_time", "forced_offsets", "next_segment",
+        "matched", "prefix", "index", "segment_index"]
+
+    def __init__(self, path, camera, cache=None, metadata=None):
         self.path = path
         self.camera = camera
         self.filename = os.path.basename(path)
-        self.tags = get_tags(get_hmmt_data(Mp4File(path)))
-        self.signature = make_signature(self.tags)
+
+        if metadata is None and cache is not None:
+            metadata = cache.get(path)
+        if metadata is None:
+            metadata = get_metadata(path)
+            if cache is not None:
+                cache.put(path, metadata)
+
+        # Tags are millisecond offsets that fit in an unsigned 32 bit int, see
+        # get_tags(), so store them compactly.
+        self.tags = array.array("I", metadata['tags'])
+        self.signature = array.array("I", metadata['signature'])
+        self.duration = metadata['duration']
+        self.fps = metadata['fps']
+        self.creation_time = metadata['creation_time']
         self.forced_offsets = {}
         self.next_segment = None
         self.matched = set()
@@ -84,24 +174,6 @@ class Segment(object):
     def is_root_segment(self):
         return self.segment_index == 0
 
-    def find_subsequent_segments(self, segments):
-        """Attempt to match up any multi-part segments."""
-
-        for other in segments:
-            if other.camera != self.camera:
-                # From another camera, not a related segment.
-                continue
-
-            if other.index != self.index:
-                # Different index, not a related segment.
-                continue
-    
-            if other.segment_index != self.segment_index + 1:
-                # This is a related segment, but it is not the /next/ segment.
-                continue
-            
-            self.next_segment = other
-    
     def series(self):
         yield self
 
@@ -112,52 +184,50 @@ class Segment(object):
             yield nxt
             nxt = nxt.next_segment
     
-    def get_score(self, other):
+    def get_match(self, other):
+        """Return a matching.Match describing how other lines up with this
+        segment, or None if they can't be lined up."""
         if other == self:
             # Don't match against own segment.
             return None
 
         # If we have a forced offset, use that.
         try:
-            return self.forced_offsets[other]
+            return matching.Match(self.forced_offsets[other], 1.0, 0.0)
         except KeyError:
             pass
-   
-        if len(self.signature) != len(other.signature):
-            # Signatures not the same length, they can't be a match.
-            return None
-
-        sigmatch = []
-        for (a, b) in zip(self.signature, other.signature):
-            sigmatch.append(abs(a - b))
-
-        score = sum(sigmatch) / float(len(sigmatch))
-        return score
 
+        return matching.align(self.tags, other.tags)
 
-    def find_other_camera_segments(self, segments):
+    def find_other_camera_segments(self, index):
         if len(self.signature) == 0:
             # No signature matching possible if we don't have a signature.
             return
 
-        candidates = []
+        # Only the segments sharing some tag intervals with this one are
+        # considered, rather than every segment in the index.
+        best = {}
+        for (other, match) in index.match(self.tags):
+            if other.camera == self.camera:
+                # A camera can't record two sessions at once.
+                continue
 
-        for other in segments:
-            score = self.get_score(other)
-            if score is not None:
-                candidates.append((other, score))
-        
-        if len(candidates) > 0:
-            # The candidate with the lowest score is likely to be the
-            # right one to match with this segment.
-            candidates.sort(key=lambda (c, s): s)
-            (segment, score) = candidates[0]
+            if match.confidence < MIN_MATCH_CONFIDENCE:
+                continue
+
+            # The candidate from each camera with the most tags lined up, and
+            # then the smallest error, is likely to be the right one to match
+            # with this segment.
+            rank = (match.confidence, -match.error)
+            if other.camera not in best or rank > best[other.camera][0]:
+                best[other.camera] = (rank, other)
 
+        for (rank, segment) in best.values():
             # Set up a bidirectional mapping between these segments.
             self.matched.add(segment)
             segment.matched.add(self)
 
-def add_view(session, segment, offset=None):
+def add_view(session, segment, offset=None, confidence=None):
     try:
         session['views']
     except KeyError:
@@ -166,141 +236,517 @@ def add_view(session, segment, offset=None):
     view = {"paths": []}
     if offset is not None:
         view["offset"] = offset
+    if confidence is not None:
+        view["confidence"] = confidence
 
     for seg in segment.series():
         view['paths'].append(seg.path)
 
+    # HiLight tags are kept so that tools working on the session can find
+    # the interesting parts of it.
+    if len(segment.tags) > 0:
+        view['tags'] = [int(tag) for tag in segment.tags]
+
     session['views'][segment.camera] = view
 
-def get_segment_by_filename(segments, filename):
-    for segment in segments:
-        if segment.filename == filename:
-            return segment
-    raise KeyError("No segment with filename '%s'" % filename)
+class SegmentCatalog(object):
+    """Owns all the segments, indexed by their position in a series and by
+    filename so that neither linking series nor looking up segments requires
+    a scan over every segment."""
+
+    def __init__(self):
+        self.segments = []
+        self.by_key = {}
+        self.by_filename = {}
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add(self, segment):
+        self.segments.append(segment)
+        key = (segment.camera, segment.index, segment.segment_index)
+        self.by_key[key] = segment
+        # Filenames may be repeated across cameras, the first one added wins.
+        self.by_filename.setdefault(segment.filename, segment)
+
+    def link(self, segment):
+        """Link segment into its series, between whichever of the segments
+        before and after it have been added."""
+        key = (segment.camera, segment.index)
+        segment.next_segment = self.by_key.get(key + (segment.segment_index + 1,))
+        previous = self.by_key.get(key + (segment.segment_index - 1,))
+        if previous is not None:
+            previous.next_segment = segment
+
+    def remove(self, segment):
+        """Remove segment, such as when its file has changed and it's about
+        to be replaced."""
+        self.segments.remove(segment)
+        key = (segment.camera, segment.index, segment.segment_index)
+        if self.by_key.get(key) is segment:
+            del self.by_key[key]
+        previous = self.by_key.get(key[:2] + (segment.segment_index - 1,))
+        if previous is not None and previous.next_segment is segment:
+            previous.next_segment = None
+
+        if self.by_filename.get(segment.filename) is segment:
+            del self.by_filename[segment.filename]
+            for other in self.segments:
+                if other.filename == segment.filename:
+                    self.by_filename[other.filename] = other
+                    break
+
+    def link_series(self):
+        """Attempt to match up any multi-part segments."""
+        for segment in self.segments:
+            self.link(segment)
 
-def get_all_matched_segments(segment, matched=None):
-    if matched is None:
-        matched = set()
+    def get_root(self, segment):
+        """Return the root segment of the series segment is part of, or None
+        if it hasn't been added."""
+        return self.by_key.get((segment.camera, segment.index, 0))
 
-    for seg in segment.matched:
-        if seg not in matched:
-            matched.add(seg)
-            matched.update(get_all_matched_segments(seg, matched))
-    
-    return matched
+    def root_segments(self):
+        return [s for s in self.segments if s.is_root_segment()]
 
-if __name__ == '__main__':
-    for camera_path in sys.argv[1:]:
-        camera_name = os.path.basename(camera_path)
-        for path in glob.glob(os.path.join(camera_path, "*.MP4")):
-            segments.append(Segment(path, camera_name))
-    
-    # Once we've loaded all segments, ask each segment to try to find any
-    # other segments that were recorded as part of the same session.
-    for segment in segments:
-        segment.find_subsequent_segments(segments)
+    def get_by_filename(self, filename):
+        try:
+            return self.by_filename[filename]
+        except KeyError:
+            raise KeyError("No segment with filename '%s'" % filename)
+
+# Audio offsets lining up less well than this aren't used in place of a
+# missing tag offset.
+MIN_AUDIO_CONFIDENCE = 0.3
+
+def add_audio_offset(session, segment, other, envelopes, seconds):
+    """Cross-correlate the audio of other with the reference segment and
+    record the result in other's view alongside the tag offset. If there was
+    no tag offset, the audio offset is used instead if it is good enough."""
+    for seg in (segment, other):
+        if seg.path not in envelopes:
+            envelopes[seg.path] = audiosync.get_envelope(seg.path, seconds)
+
+    result = audiosync.correlate(envelopes[segment.path], envelopes[other.path])
+    if result is None:
+        return
+    (offset, confidence) = result
+
+    view = session['views'][other.camera]
+    view['audio_offset'] = offset
+    view['audio_confidence'] = confidence
+    session['views'][segment.camera]['audio_offset'] = 0
+
+    if 'offset' not in view and confidence >= MIN_AUDIO_CONFIDENCE:
+        view['offset'] = offset
+        view['confidence'] = confidence
+        view['offset_source'] = "audio"
+
+class DisjointSet(object):
+    """Union-find structure used to group segments that have been matched
+    together, directly or through other segments, into sessions."""
+
+    def __init__(self):
+        # Ordered so that groups come out in the order items were added.
+        self.parent = collections.OrderedDict()
+        self.rank = {}
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.rank[item] = 0
+
+    def find(self, item):
+        self.add(item)
+
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        # Point everything along the path directly at the root, so finding
+        # any of them again is quick.
+        while self.parent[item] != root:
+            (self.parent[item], item) = (root, self.parent[item])
+
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
 
-    root_segments = [s for s in segments if s.is_root_segment()]
-   
-    # Attempt to have each root segment match itself with root segments from
-    # other cameras, based on the timestamped tag metadata.
+        # Attach the shallower tree beneath the deeper one.
+        if self.rank[a] < self.rank[b]:
+            (a, b) = (b, a)
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+    def groups(self):
+        """Return a list of groups, each a list of items in the order they
+        were added."""
+        groups = collections.OrderedDict()
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups.values()
+
+def get_session_groups(root_segments):
+    """Group root_segments into sessions of matched segments. Returns a list
+    of (reference, members) tuples, where reference is the segment in members
+    that offsets should be calculated relative to."""
+    groups = DisjointSet()
     for segment in root_segments:
-        segment.find_other_camera_segments(root_segments) 
-    
-    # Apply corrections provided by the user.
-    corrections = yaml.load(open("corrections.yaml").read())
+        groups.add(segment)
+
+    for segment in root_segments:
+        for other in segment.matched:
+            groups.union(segment, other)
+
+    session_groups = []
+    for members in groups.groups():
+        # All the offsets are calculated relative to the reference segment,
+        # and if that segment doesn't have a signature, no offsets can be
+        # calculated at all. Make sure that a segment with a signature will
+        # always be the reference if there is one, but don't skip sessions
+        # where none of the segments have signatures.
+        with_signature = [seg for seg in members if len(seg.signature) > 0]
+        reference = (with_signature or members)[0]
+        session_groups.append((reference, members))
+
+    return session_groups
+
+def match_segments(root_segments):
+    """Have each of root_segments match itself with root segments from other
+    cameras, based on the timestamped tag metadata."""
+    index = matching.SignatureIndex()
+    for segment in root_segments:
+        index.add(segment, segment.tags)
+
+    for segment in root_segments:
+        segment.find_other_camera_segments(index)
+
+def convert_legacy_offset(segment, other, offset):
+    """Convert an offset correction from before view_offset existed to the
+    offset of other from segment as returned by get_match. Those offsets had
+    their direction chosen by which segment's first tag came later, and were
+    inserted as a delay before the view rather than skipped."""
+    if len(segment.tags) == 0 or len(other.tags) == 0:
+        # Without tags the offset was ignored.
+        return 0
+    if segment.tags[0] > other.tags[0]:
+        return offset
+    return -offset
+
+def apply_corrections(segments, corrections):
+    """Apply the corrections provided by the user in corrections.yaml to the
+    segments in the SegmentCatalog segments."""
     for correction in corrections:
         if correction['action'] == "forcematch":
             filename1, filename2 = correction['filenames'].split(" ")
-            segment1 = get_segment_by_filename(segments, filename1)
-            segment2 = get_segment_by_filename(segments, filename2)
+            segment1 = segments.get_by_filename(filename1)
+            segment2 = segments.get_by_filename(filename2)
             segment1.matched.add(segment2)
             segment2.matched.add(segment1)
             
-            try:
-                segment1.forced_offsets[segment2] = correction['offset']
-                segment2.forced_offsets[segment1] = -correction['offset']
-            except KeyError:
-                # The user may not have provided an offset correction.
-                pass
+            # The user may not have provided an offset correction.
+            if 'view_offset' in correction:
+                segment1.forced_offsets[segment2] = correction['view_offset']
+                segment2.forced_offsets[segment1] = -correction['view_offset']
+            elif 'offset' in correction:
+                segment1.forced_offsets[segment2] = convert_legacy_offset(
+                    segment1, segment2, correction['offset'])
+                segment2.forced_offsets[segment1] = convert_legacy_offset(
+                    segment2, segment1, -correction['offset'])
+
+def build_session(segment, members, audio_sync=False,
+        audio_seconds=audiosync.MAX_SECONDS, envelopes=None):
+    """Build a session dict, as written to sessions.yaml, for the matched
+    segments in members with offsets relative to the reference segment."""
+    if envelopes is None:
+        envelopes = {}
+
+    session = {}
+    add_view(session, segment)
+
+    for other in members:
+        if other is segment:
+            continue
 
-    for segment in root_segments:
-        if len(segment.matched) == 0:
-            print "%r doesn't have any synced matches" % segment
+        match = segment.get_match(other)
+        if match is None:
+            # If these two segments can't be lined up, we have no way
+            # of calculating an offset. Assume no offset and hope they
+            # line up well, or perhaps the user will provide an
+            # offset manually later.
+            offset = None
+            confidence = None
+        else:
+            # The match offset is the difference between the times of
+            # the same tag in each segment, so it's how far into the
+            # other segment this one started recording.
+            offset = match.offset
+            confidence = match.confidence
+
+        add_view(session, other, offset, confidence)
+
+        if audio_sync:
+            add_audio_offset(session, segment, other, envelopes,
+                audio_seconds)
+
+    # When all the views have been loaded, look at all the offsets
+    # and align them all to the smallest one so that there are no
+    # negative offsets in the output. This is desirable because
+    # whatever video processing tools operate on this later will
+    # laugh at the concept of seeking to a negative offset. Audio offsets
+    # are shifted by the same amount so the two can be compared.
+    adj = -min(0, min(view.get('offset', 0) for view in session['views'].values()))
+    for view in session['views'].values():
+        view['offset'] = view.get('offset', 0) + adj
+        if 'audio_offset' in view:
+            view['audio_offset'] += adj
+
+    add_session_times(session, segment, members)
+    return session
+
+def add_session_times(session, segment, members):
+    """Add the time the session started, by the clock of the camera that
+    recorded the reference segment, and how long it lasted, both in seconds.
+    Either is left out if it can't be worked out from the videos."""
+    # Camera clocks are set by hand and may disagree, so only the reference
+    # segment's clock is used if it has one.
+    for seg in [segment] + members:
+        if seg.creation_time is not None:
+            offset = session['views'][seg.camera]['offset']
+            session['start_time'] = seg.creation_time + offset / 1000.0
+            break
+
+    durations = []
+    for seg in members:
+        series = list(seg.series())
+        if all(s.duration is not None for s in series):
+            offset = session['views'][seg.camera]['offset']
+            durations.append(sum(s.duration for s in series) - offset / 1000.0)
+    if durations:
+        session['duration'] = max(durations)
+
+def build_sessions(root_segments, audio_sync=False,
+        audio_seconds=audiosync.MAX_SECONDS):
+    """Build a session dict for each group of matched segments."""
+    # Audio envelopes by path, as the reference segment is correlated with
+    # every other segment in its session.
+    envelopes = {}
+
+    return [build_session(segment, members, audio_sync, audio_seconds, envelopes)
+        for (segment, members) in get_session_groups(root_segments)]
+
+def get_session_sort_key(session):
+    """Sessions are sorted by the filename of the front camera's recording,
+    or the first of the other cameras' if the front camera is missing."""
+    views = session['views']
+    if 'front' in views:
+        return os.path.basename(views['front']['paths'][0])
+    return min(os.path.basename(view['paths'][0]) for view in views.values())
+
+def find_files(camera_paths):
+    """Return a list of (path, camera) tuples for the videos in each of
+    camera_paths, which are named after their camera."""
+    files = []
+    for camera_path in camera_paths:
+        camera_name = os.path.basename(camera_path)
+        for path in glob.glob(os.path.join(camera_path, "*.MP4")):
+            files.append((path, camera_name))
+    return files
+
+def remove_duplicates(files, cache, seen=None, keep=False):
+    """Return the (path, camera) tuples in files without any that are copies
+    of a file earlier in files, such as when a card has been copied twice or
+    into the wrong camera's directory. Copies would otherwise become segments
+    with the same tags and be matched with each other. seen maps the
+    fingerprints of files already found to their paths, and is updated. If
+    keep is True, copies are reported but not removed."""
+    if seen is None:
+        seen = {}
+
+    unique = []
+    for (path, camera) in files:
+        fingerprint = cache.get_fingerprint(path)
+        if fingerprint in seen:
+            print "%s is a copy of %s%s" % (path, seen[fingerprint],
+                "" if keep else ", ignoring it")
+            profiling.count("duplicates")
+            if not keep:
+                continue
+        else:
+            seen[fingerprint] = path
+        unique.append((path, camera))
+    return unique
+
+def load_metadata(paths, cache, jobs=1, jobs_per_device=1):
+    """Return a dict of metadata for each of paths, loaded from cache where
+    possible and extracted in parallel otherwise."""
+    metadata = {}
+    with profiling.stage("cache_lookup"):
+        for path in paths:
+            cached = cache.get(path)
+            if cached is not None:
+                metadata[path] = cached
+    profiling.count("cache_hits", len(metadata))
+
+    missing = [path for path in paths if path not in metadata]
+    with profiling.stage("metadata_extraction"):
+        for (path, extracted) in extract_metadata(missing, jobs, jobs_per_device):
+            cache.put(path, extracted)
+            metadata[path] = extracted
+
+    return metadata
 
-    sessions = []
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("camera_paths", nargs="+")
+    parser.add_argument("--cache", action="store", default="metadata-cache.sqlite")
+    parser.add_argument("--rebuild-cache", action="store_true", default=False)
+    parser.add_argument("--jobs", action="store", type=int, default=4)
+    parser.add_argument("--jobs-per-device", action="store", type=int, default=1)
+    parser.add_argument("--keep-duplicates", action="store_true", default=False,
+        help="Only warn about copies of the same file, rather than ignoring "
+        "all but the first.")
+    parser.add_argument("--proxy-dir", action="store", default=proxies.PROXY_DIR)
+    parser.add_argument("--audio-sync", action="store_true", default=False)
+    parser.add_argument("--audio-seconds", action="store", type=int,
+        default=audiosync.MAX_SECONDS)
+    parser.add_argument("--log", action="append", default=[],
+        help="A GPS log (NMEA, or CSV with a .csv extension) to match with the "
+        "sessions. May be given more than once.")
+    parser.add_argument("--utc-offset", action="store", type=float, default=0.0,
+        help="Hours the cameras' clocks are ahead of UTC.")
+    parser.add_argument("--start-finish", action="store", type=laps.parse_line,
+        default=None, help="The start/finish line for timing laps, as "
+        "lat1,lon1,lat2,lon2. Defaults to across the fastest part of each log.")
+    parser.add_argument("--telemetry", action="append", default=[],
+        help="An engine telemetry CSV log to match with the sessions. May be "
+        "given more than once.")
+    parser.add_argument("--telemetry-start", action="store",
+        type=gpslog.parse_time, default=None, help="When logging started, "
+        "in UTC, for telemetry logs with times relative to the start of "
+        "logging.")
+    parser.add_argument("--telemetry-dir", action="store",
+        default=telemetry.TELEMETRY_DIR)
+    parser.add_argument("--profile", action="store", default=None,
+        help="Write timing and I/O statistics to this file as JSON.")
+    parser.add_argument("--cprofile", action="store", default=None,
+        help="Write cProfile stats to this file.")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+    if args.cprofile:
+        profiler = profiling.start_cprofile()
+
+    # Metadata for files that haven't changed since the last run is loaded
+    # from the cache rather than extracted from the files again.
+    cache = metacache.MetadataCache(args.cache)
+    if args.rebuild_cache:
+        cache.clear()
+
+    files = find_files(args.camera_paths)
+    profiling.count("files", len(files))
+
+    # The fingerprints are kept in the cache, so this only reads files that
+    # are new or have changed, and those are fingerprinted anyway when
+    # looking them up in the cache.
+    with profiling.stage("duplicate_detection"):
+        files = remove_duplicates(files, cache, keep=args.keep_duplicates)
+
+    # Extract metadata for everything that wasn't cached in parallel, then
+    # build the segments from the results in the main thread.
+    metadata = load_metadata([path for (path, camera_name) in files], cache,
+        args.jobs, args.jobs_per_device)
+
+    segments = SegmentCatalog()
+    for (path, camera_name) in files:
+        segments.add(Segment(path, camera_name, metadata=metadata[path]))
+    profiling.count("segments", len(segments))
+
+    with profiling.stage("cache_save"):
+        cache.prune()
+        cache.save()
+    
+    # Once we've loaded all segments, link up any segments that were
+    # recorded as parts of the same series.
+    with profiling.stage("series_linking"):
+        segments.link_series()
 
-    segments_used = set()
+    root_segments = segments.root_segments()
+    profiling.count("root_segments", len(root_segments))
+   
+    # Attempt to have each root segment match itself with root segments from
+    # other cameras, based on the timestamped tag metadata.
+    with profiling.stage("signature_matching"):
+        match_segments(root_segments)
+    
+    # Apply corrections provided by the user.
+    with profiling.stage("corrections"):
+        apply_corrections(segments, yaml.load(open("corrections.yaml").read()))
 
     for segment in root_segments:
-        
-        # Recursively find all the other segments this one has been matched with.
-        all_matched_segments = get_all_matched_segments(segment)
-        
-        # Skip segments that don't have a signature, are matched with at least
-        # one other segment, and that other segment does have a signature.
-        # The reason for this is that all the offsets are calculated relative
-        # to the *first* segment considered, and if that first segment doesn't
-        # have a signature, no offsets can be calculated at all. This tries to
-        # make sure that a segment with a signature will always be the first
-        # segment in a session. At the same time, we shouldn't completely skip
-        # sessions if none of the segments have signatures.
-        if len(all_matched_segments) > 1 and \
-            len(segment.signature) == 0 and \
-            any(filter(lambda seg: len(seg.signature) > 0, all_matched_segments)):
-            continue
+        if len(segment.matched) == 0:
+            print "%r doesn't have any synced matches" % segment
 
-        if segment not in segments_used:
-            session = {}
-            add_view(session, segment)
-            segments_used.add(segment)
-
-            for other in all_matched_segments:
-                score = segment.get_score(other)
-                if score is None:
-                    # If there's no match score between these two segments,
-                    # we have no way of calculating an offset. Assume no
-                    # offset and hope they line up well, or perhaps the user
-                    # will provide an offset manually later.
-                    score = 0
-
-                # Convert the score to an offset with a direction.
-                try:
-                    if segment.tags[0] > other.tags[0]:
-                        offset = -score
-                    else:
-                        offset = score
-                except IndexError:
-                    offset = None
-
-                add_view(session, other, offset)
-                segments_used.add(other)
-
-            # When all the views have been loaded, look at all the offsets
-            # and align them all to the smallest one so that there are no
-            # negative offsets in the output. This is desirable because
-            # whatever video processing tools operate on this later will
-            # laugh at the concept of seeking to a negative offset.
-
-            views_by_offset = []
-            for camera, view in session['views'].items():
-                views_by_offset.append([camera, view.get('offset', 0)])
-
-            views_by_offset.sort(key=lambda (cam, off): off)
-            for view in views_by_offset:
-                if view[1] < 0:
-                    adj = -view[1]
-                    # Add adj to every offset.
-                    for view in views_by_offset:
-                        view[1] += adj
-            for camera, offset in views_by_offset:
-                session['views'][camera]['offset'] = offset
-
-            sessions.append(session)
+    with profiling.stage("session_building"):
+        sessions = build_sessions(root_segments, args.audio_sync, args.audio_seconds)
+        for session in sessions:
+            proxies.add_proxy_paths(session, args.proxy_dir)
+    profiling.count("sessions", len(sessions))
 
     # Sort sessions by filename order
-    sessions.sort(key=lambda s: s['views']['front']['paths'][0])
+    sessions.sort(key=get_session_sort_key)
+
+    if args.log:
+        with profiling.stage("log_matching"):
+            logs = {}
+            log_segments = []
+            for path in args.log:
+                logs[path] = gpslog.read_log(path)
+                log_segments.extend(gpslog.split_sessions(logs[path]))
+            matched = gpslog.attach_logs(sessions, log_segments,
+                args.utc_offset * 3600)
+        print "Found %d sessions in GPS logs, matched %d of %d sessions" % (
+            len(log_segments), matched, len(sessions))
+
+        with profiling.stage("lap_detection"):
+            lines = {}
+            for session in sessions:
+                if 'log' not in session:
+                    continue
+                path = session['log']['path']
+                if path not in lines:
+                    lines[path] = args.start_finish or laps.find_start_finish(logs[path])
+                if lines[path] is not None:
+                    laps.add_laps(session, logs[path], lines[path])
+
+    if args.telemetry:
+        telemetry_logs = []
+        for path in args.telemetry:
+            try:
+                telemetry_logs.append(telemetry.open_log(path,
+                    args.telemetry_dir, args.telemetry_start))
+            except (IOError, OSError, ValueError) as ex:
+                print >> sys.stderr, "%s: couldn't import telemetry: %s" % (path, ex)
+        with profiling.stage("telemetry_matching"):
+            matched = telemetry.attach_telemetry(sessions, telemetry_logs,
+                args.utc_offset * 3600)
+        print "Matched telemetry to %d of %d sessions" % (matched, len(sessions))
    
-    # Write all the session data out to a file.
-    open("sessions.yaml", "w").write(yaml.dump(sessions))
-    
+    # Write all the session data out to a file, along with an index of it
+    # that lets the other tools load one session at a time.
+    with profiling.stage("yaml_write"):
+        sessionstore.save_sessions(sessions, "sessions.yaml")
+
+    if args.cprofile:
+        profiling.stop_cprofile(profiler, args.cprofile)
+    if args.profile:
+        profiling.write_report(args.profile)
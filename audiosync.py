@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Estimate offsets between cameras by cross-correlating their audio.
+
+A short stretch of audio from the start of each file is decoded by ffmpeg as
+low sample rate mono, reduced to an amplitude envelope and the envelopes are
+cross-correlated using FFTs. Engine noise at a track day is loud and varies a
+lot, which makes the envelope a good thing to line up.
+"""
+
+import subprocess
+
+import numpy
+
+# Sample rate to have ffmpeg decode audio at.
+DECODE_RATE = 8000
+
+# Sample rate of the envelope which is actually correlated, which sets the
+# resolution of the offsets found.
+ENVELOPE_RATE = 200
+
+# How much audio to decode from each file.
+MAX_SECONDS = 180
+
+# How far apart two cameras can have started recording and still be lined up.
+MAX_OFFSET_MS = 60000
+
+# Bytes read from ffmpeg at a time, to bound memory use while decoding.
+READ_SIZE = 64 * 1024
+
+def get_envelope(path, seconds=MAX_SECONDS):
+    """Return the amplitude envelope of the first seconds of audio in the
+    file at path as a numpy array sampled at ENVELOPE_RATE, or None if there
+    is no audio that can be decoded."""
+    block = DECODE_RATE // ENVELOPE_RATE
+    command = ["ffmpeg", "-v", "error", "-nostdin",
+        "-t", str(seconds), "-i", path,
+        "-vn", "-ac", "1", "-ar", str(DECODE_RATE),
+        "-f", "s16le", "-"]
+
+    try:
+        decoder = subprocess.Popen(command, stdout=subprocess.PIPE)
+    except OSError:
+        # ffmpeg isn't installed.
+        return None
+
+    # Reduce the audio to an envelope as it is decoded, rather than holding
+    # all the decoded samples in memory at once.
+    envelope = []
+    leftover = ""
+    while True:
+        chunk = decoder.stdout.read(READ_SIZE)
+        if not chunk:
+            break
+
+        data = leftover + chunk
+        usable = len(data) - (len(data) % (2 * block))
+        leftover = data[usable:]
+
+        samples = numpy.frombuffer(data[:usable], dtype="<i2")
+        envelope.append(numpy.abs(samples.astype(numpy.float32))
+            .reshape(-1, block).mean(axis=1))
+
+    decoder.wait()
+    if decoder.returncode != 0 or len(envelope) == 0:
+        return None
+
+    return numpy.concatenate(envelope)
+
+def correlate(envelope, other_envelope, max_offset_ms=MAX_OFFSET_MS):
+    """Find the offset in milliseconds which lines up envelope with
+    other_envelope, such that something heard at time t in the first is heard
+    at t + offset in the second. Returns (offset, confidence) where confidence
+    is the correlation coefficient at that offset, or None if the envelopes
+    are too short or flat to line up."""
+    if envelope is None or other_envelope is None:
+        return None
+
+    a = envelope - envelope.mean()
+    b = other_envelope - other_envelope.mean()
+    if a.std() == 0 or b.std() == 0:
+        return None
+    a /= a.std()
+    b /= b.std()
+
+    # Zero pad to avoid the correlation wrapping around, rounding up to a
+    # power of two to keep the FFTs fast.
+    size = 1
+    while size < len(a) + len(b):
+        size *= 2
+
+    correlation = numpy.fft.irfft(
+        numpy.conj(numpy.fft.rfft(a, size)) * numpy.fft.rfft(b, size), size)
+
+    # Positive lags are at the start of the result and negative lags wrap
+    # around to the end. Only look for the peak within the search window.
+    max_lag = min(int(max_offset_ms * ENVELOPE_RATE / 1000), size // 2 - 1)
+    lags = numpy.concatenate([numpy.arange(0, max_lag + 1),
+        numpy.arange(-max_lag, 0)])
+    window = numpy.concatenate([correlation[:max_lag + 1],
+        correlation[size - max_lag:]])
+
+    best = int(numpy.argmax(window))
+    lag = int(lags[best])
+
+    # Normalise by the amount of overlap at this lag to get a correlation
+    # coefficient.
+    overlap = min(len(a), len(b) - lag) if lag >= 0 else min(len(a) + lag, len(b))
+    if overlap <= 0:
+        return None
+    confidence = max(0.0, min(1.0, float(window[best]) / overlap))
+
+    return (int(round(lag * 1000.0 / ENVELOPE_RATE)), confidence)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Benchmark the assemble and render pipelines against synthetic data.
+
+Generates a track day's worth of GoPro-like MP4 files (sparse, so they take
+up next to no disk space no matter how large they claim to be), runs each
+stage of the pipeline over them and reports how long each stage took as
+JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import platform
+
+import yaml
+
+import mp4box
+import assemble
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def full_box(box_type, payload, version=0, flags=0):
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+def write_mp4(path, tags, frames, fps, mdat_size, noise="", creation_time=0):
+    """Write a minimal MP4 to path with a HMMT box holding tags and a single
+    video track of frames frames at fps. The mdat starts with noise, standing
+    in for the encoded video that makes each real file unique, and the rest
+    of it is left as a hole of mdat_size bytes. The moov follows it as on
+    GoPro cameras. creation_time is in seconds since the Unix epoch."""
+    if creation_time:
+        creation_time += mp4box.MP4_EPOCH_OFFSET
+    timescale = int(round(fps * 1000))
+    duration = frames * 1000
+
+    mvhd = full_box("mvhd", struct.pack(">IIII", creation_time, creation_time,
+        timescale, duration) + "\0" * 80)
+    mdhd = full_box("mdhd", struct.pack(">IIIIHH", creation_time, creation_time,
+        timescale, duration, 0, 0))
+    hdlr = full_box("hdlr", struct.pack(">I4s12x", 0, "vide") + "\0")
+    stts = full_box("stts", struct.pack(">III", 1, frames, 1000))
+    trak = box("trak", box("mdia", mdhd + hdlr +
+        box("minf", box("stbl", stts))))
+    hmmt = box("HMMT", struct.pack(">I" + "I" * len(tags), len(tags), *tags))
+    moov = box("moov", mvhd + trak + box("udta", hmmt))
+
+    with open(path, "wb") as f:
+        f.write(box("ftyp", "avc1isom"))
+        f.write(struct.pack(">I4sQ", 1, "mdat", 16 + len(noise) + mdat_size))
+        f.write(noise)
+        f.seek(mdat_size, os.SEEK_CUR)
+        f.write(moov)
+
+def generate_archive(root, args):
+    """Generate a directory per camera under root, filled with synthetic
+    recordings of args.sessions sessions. Returns a list of (path, camera)
+    tuples for all the files created."""
+    rng = random.Random(args.seed)
+    fps = 59.94
+    # Sessions run every 40 minutes from 9am on 2020-06-06.
+    day_start = 1591434000
+    files = []
+
+    for camera in args.cameras:
+        os.makedirs(os.path.join(root, camera))
+
+    for session in range(args.sessions):
+        # The times of each HiLight press, from the start of the session.
+        presses = sorted(rng.randint(30000, 1500000) for i in range(args.tags))
+        chapters = rng.randint(1, args.chapters)
+        index = "%04d" % (session + 1)
+
+        for camera in args.cameras:
+            # Each camera starts recording at a slightly different time, and
+            # occasionally misses a tag.
+            start = rng.randint(0, 20000)
+            creation_time = day_start + session * 2400 + start // 1000
+            tags = [press - start + rng.randint(-30, 30) for press in presses]
+            if len(tags) > 2 and rng.random() < 0.1:
+                del tags[rng.randrange(len(tags))]
+
+            for chapter in range(chapters):
+                if chapter == 0:
+                    filename = "GOPR%s.MP4" % index
+                    chapter_tags = tags
+                else:
+                    filename = "GP%02d%s.MP4" % (chapter, index)
+                    chapter_tags = []
+
+                path = os.path.join(root, camera, filename)
+                noise = "".join(chr(rng.randrange(256)) for i in range(64))
+                write_mp4(path, chapter_tags, int(fps * 60 * 17), fps,
+                    args.file_size * 1024 * 1024, noise,
+                    creation_time + chapter * 17 * 60)
+                files.append((path, camera))
+
+    return files
+
+def time_stage(results, name, items, func, *args):
+    """Call func with args, recording its wall and CPU time in results under
+    name along with the number of items it processed. Returns whatever func
+    returns."""
+    start_times = os.times()
+    start = time.time()
+    retval = func(*args)
+    wall = time.time() - start
+    end_times = os.times()
+
+    cpu = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+    results[name] = {"wall": wall, "cpu": cpu, "items": items}
+    return retval
+
+def extract_tags(files):
+    return dict((path, assemble.get_metadata(path)) for (path, camera) in files)
+
+def build_catalog(files, metadata):
+    segments = assemble.SegmentCatalog()
+    for (path, camera) in files:
+        segments.add(assemble.Segment(path, camera, metadata=metadata[path]))
+    return segments
+
+def write_yaml(sessions, path):
+    open(path, "w").write(yaml.dump(sessions))
+
+def generate_mlt(render, sessions, layout):
+    for session in sessions:
+        video_details = {}
+        for view in session['views'].values():
+            for path in view['paths']:
+                video_details[path] = render.get_video_details(path)
+        render.add_offset_frames(session, video_details)
+        render.make_mlt(session, video_details, layout)
+
+def run(root, args):
+    results = {}
+
+    files = time_stage(results, "generate", None, generate_archive, root, args)
+    metadata = time_stage(results, "tag_extraction", len(files),
+        extract_tags, files)
+    segments = time_stage(results, "segment_creation", len(files),
+        build_catalog, files, metadata)
+    time_stage(results, "series_linking", len(segments), segments.link_series)
+
+    root_segments = segments.root_segments()
+    time_stage(results, "signature_matching", len(root_segments),
+        assemble.match_segments, root_segments)
+    sessions = time_stage(results, "session_building", len(root_segments),
+        assemble.build_sessions, root_segments)
+    time_stage(results, "yaml_write", len(sessions),
+        write_yaml, sessions, os.path.join(root, "sessions.yaml"))
+
+    try:
+        import render
+    except ImportError as ex:
+        results["mlt_generation"] = {"skipped": str(ex)}
+    else:
+        time_stage(results, "mlt_generation", len(sessions),
+            generate_mlt, render, sessions, args.cameras)
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", action="store", type=int, default=15)
+    parser.add_argument("--cameras", action="store", default="front:inside:back")
+    parser.add_argument("--tags", action="store", type=int, default=6)
+    parser.add_argument("--chapters", action="store", type=int, default=3,
+        help="Maximum number of chapters per recording.")
+    parser.add_argument("--file-size", action="store", type=int, default=4000,
+        help="Apparent size of each file in MB.")
+    parser.add_argument("--seed", action="store", type=int, default=0)
+    parser.add_argument("--dir", action="store", default=None,
+        help="Generate files here instead of a temporary directory.")
+    parser.add_argument("--output", action="store", default=None)
+    args = parser.parse_args()
+    args.cameras = args.cameras.split(":")
+
+    root = args.dir or tempfile.mkdtemp(prefix="trackdayvideo-bench-")
+    try:
+        stages = run(root, args)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(root)
+
+    report = {
+        "python": platform.python_version(),
+        "parameters": {
+            "sessions": args.sessions,
+            "cameras": args.cameras,
+            "tags": args.tags,
+            "chapters": args.chapters,
+            "file_size": args.file_size,
+            "seed": args.seed,
+        },
+        "stages": stages,
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print output
+    else:
+        open(args.output, "w").write(output + "\n")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""Reading GPS logs and matching them up with sessions.
+
+Logs are read a line at a time into compact arrays, so a full day of fixes
+at 25Hz takes tens of megabytes however large the log file is. NMEA logs
+(RMC sentences) and CSV exports from common lap timers and data loggers are
+supported.
+"""
+
+import os
+import csv
+import array
+import calendar
+import datetime
+import collections
+
+import numpy
+
+# Fixes slower than this, in metres per second, are taken as being stopped
+# in the pits or paddock rather than out on track.
+MIN_SPEED = 5.0
+
+# A gap of this many seconds without moving fixes ends a session.
+MAX_GAP = 60.0
+
+# Sessions shorter than this many seconds are ignored.
+MIN_SESSION_LENGTH = 60.0
+
+KNOTS = 0.514444
+
+class GPSLog(object):
+    """GPS fixes, sorted by time. times are seconds since the Unix epoch in
+    UTC, latitude and longitude in degrees and speed in metres per second."""
+
+    def __init__(self, path, times, latitude, longitude, speed):
+        self.path = path
+        order = numpy.argsort(times, kind="mergesort")
+        self.times = times[order]
+        self.latitude = latitude[order]
+        self.longitude = longitude[order]
+        self.speed = speed[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    def get_range(self, start_time, end_time):
+        """Return (start, end) indexes of the fixes from start_time up to
+        end_time."""
+        return (int(numpy.searchsorted(self.times, start_time, side="left")),
+            int(numpy.searchsorted(self.times, end_time, side="left")))
+
+# A period of driving within a GPSLog, from the fix at index start up to the
+# fix at index end.
+LogSegment = collections.namedtuple("LogSegment",
+    ["log", "start", "end", "start_time", "end_time"])
+
+class _Columns(object):
+    """Accumulates fixes in arrays, which take 8 bytes per value rather than
+    the dozens a list of floats would."""
+
+    def __init__(self):
+        self.times = array.array("d")
+        self.latitude = array.array("d")
+        self.longitude = array.array("d")
+        self.speed = array.array("d")
+
+    def append(self, time, latitude, longitude, speed):
+        self.times.append(time)
+        self.latitude.append(latitude)
+        self.longitude.append(longitude)
+        self.speed.append(speed)
+
+    def to_log(self, path):
+        return GPSLog(path, *[numpy.frombuffer(column, dtype=numpy.float64)
+            for column in (self.times, self.latitude, self.longitude, self.speed)])
+
+def read_nmea(path):
+    """Read the RMC sentences from the NMEA log at path into a GPSLog."""
+    columns = _Columns()
+    # Converting the date is comparatively slow, and it rarely changes.
+    days = {}
+
+    # This loop runs for every line of a log of up to millions of lines, so
+    # it avoids function calls where it can.
+    with open(path) as f:
+        for line in f:
+            # Any talker, such as GP, GN or GL.
+            if line[3:6] != "RMC":
+                continue
+            # The checksum is attached to the last field, after the ones
+            # used here.
+            fields = line.split(",")
+            if len(fields) < 10 or fields[2] != "A" or not fields[1] or not fields[9]:
+                # Not a valid fix.
+                continue
+
+            try:
+                date = fields[9]
+                if date not in days:
+                    days[date] = calendar.timegm((2000 + int(date[4:6]),
+                        int(date[2:4]), int(date[0:2]), 0, 0, 0))
+                clock = fields[1]
+                time = days[date] + int(clock[0:2]) * 3600 + \
+                    int(clock[2:4]) * 60 + float(clock[4:])
+
+                # Coordinates are ddmm.mmmm and dddmm.mmmm, degrees then
+                # minutes.
+                latitude = fields[3]
+                latitude = int(latitude[:2]) + float(latitude[2:]) / 60
+                if fields[4] == "S":
+                    latitude = -latitude
+                longitude = fields[5]
+                longitude = int(longitude[:3]) + float(longitude[3:]) / 60
+                if fields[6] == "W":
+                    longitude = -longitude
+
+                columns.append(time, latitude, longitude,
+                    float(fields[7] or 0) * KNOTS)
+            except ValueError:
+                # Corrupt sentence.
+                continue
+
+    return columns.to_log(path)
+
+# Lower case column names used for each field by various loggers, in order
+# of preference.
+CSV_COLUMNS = {
+    "time": ["timestamp", "utc", "time", "date/time", "datetime"],
+    "latitude": ["latitude", "lat"],
+    "longitude": ["longitude", "lon", "lng", "long"],
+    "speed": ["speed", "gps speed", "speed (km/h)", "speed (mph)",
+        "speed (m/s)", "speed (kn)", "speed_kph", "speed_mph"],
+}
+
+def find_column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    # Fall back to a column with a name starting with one of names, such as
+    # "Latitude (deg)".
+    for name in names:
+        for (index, column) in enumerate(header):
+            if column.startswith(name):
+                return index
+    return None
+
+def _get_speed_scale(column):
+    """Return what to multiply speeds in the column called column by to get
+    metres per second, going by the units in its name."""
+    if "mph" in column:
+        return 0.44704
+    if "m/s" in column or "mps" in column:
+        return 1.0
+    if "kn" in column and "kph" not in column and "km" not in column:
+        return KNOTS
+    # Most loggers use km/h.
+    return 1 / 3.6
+
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]
+
+def parse_time(value):
+    """Return the time in value as seconds since the Unix epoch. Numbers
+    are taken as seconds since the epoch, or milliseconds if they're too
+    large to be seconds. Otherwise ISO 8601 style times in UTC are
+    accepted."""
+    try:
+        number = float(value)
+    except ValueError:
+        pass
+    else:
+        if number > 1e11:
+            return number / 1000
+        return number
+
+    value = value.rstrip("Z")
+    for time_format in TIME_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+    raise ValueError("Unrecognised time '%s'" % value)
+
+def read_csv(path):
+    """Read the fixes from the CSV log at path into a GPSLog. The first line
+    which names a time, latitude and longitude column is taken as the
+    header, skipping any preamble before it."""
+    columns = _Columns()
+
+    with open(path) as f:
+        header = None
+        for row in csv.reader(f):
+            if header is None:
+                names = [column.strip().lower() for column in row]
+                indexes = dict((field, find_column(names, candidates))
+                    for (field, candidates) in CSV_COLUMNS.items())
+                if None not in (indexes['time'], indexes['latitude'],
+                        indexes['longitude']):
+                    header = names
+                    speed_scale = 1.0
+                    if indexes['speed'] is not None:
+                        speed_scale = _get_speed_scale(names[indexes['speed']])
+                continue
+
+            try:
+                speed = 0.0
+                if indexes['speed'] is not None:
+                    speed = float(row[indexes['speed']]) * speed_scale
+                columns.append(parse_time(row[indexes['time']]),
+                    float(row[indexes['latitude']]),
+                    float(row[indexes['longitude']]),
+                    speed)
+            except (ValueError, IndexError):
+                # Blank or corrupt line, or a units row below the header.
+                continue
+
+    if header is None:
+        raise ValueError("%s doesn't have a header naming time, latitude "
+            "and longitude columns" % path)
+
+    log = columns.to_log(path)
+    if indexes['speed'] is None:
+        log.speed = get_speeds(log)
+    return log
+
+def get_speeds(log):
+    """Return the speed at each fix in log in metres per second, worked out
+    from the distance to the previous fix, for logs which don't record it."""
+    latitude = numpy.radians(log.latitude)
+    longitude = numpy.radians(log.longitude)
+    # An equirectangular approximation is plenty over the distance between
+    # consecutive fixes.
+    x = numpy.diff(longitude) * numpy.cos((latitude[1:] + latitude[:-1]) / 2)
+    y = numpy.diff(latitude)
+    distance = numpy.hypot(x, y) * 6371000
+    elapsed = numpy.maximum(numpy.diff(log.times), 1e-3)
+    return numpy.concatenate([[0.0], distance / elapsed])
+
+def read_log(path):
+    """Read the GPS log at path, in a format chosen by its extension."""
+    if os.path.splitext(path)[1].lower() == ".csv":
+        return read_csv(path)
+    return read_nmea(path)
+
+def split_sessions(log, min_speed=MIN_SPEED, max_gap=MAX_GAP,
+        min_length=MIN_SESSION_LENGTH):
+    """Split log into sessions of driving, returning a list of LogSegments.
+    A session ends when there are no fixes faster than min_speed for max_gap
+    seconds, whether because the car stopped or the log has a gap."""
+    moving = numpy.flatnonzero(log.speed >= min_speed)
+    if len(moving) == 0:
+        return []
+
+    # Break wherever consecutive moving fixes are too far apart in time.
+    breaks = numpy.flatnonzero(numpy.diff(log.times[moving]) > max_gap)
+    starts = moving[numpy.concatenate([[0], breaks + 1])]
+    ends = moving[numpy.concatenate([breaks, [len(moving) - 1]])] + 1
+
+    segments = []
+    for (start, end) in zip(starts, ends):
+        segment = LogSegment(log, int(start), int(end), log.times[start],
+            log.times[end - 1])
+        if segment.end_time - segment.start_time >= min_length:
+            segments.append(segment)
+    return segments
+
+def attach_logs(sessions, segments, clock_offset=0.0):
+    """Record the log segment which overlaps most with each of sessions in
+    the session's log. clock_offset is how many seconds the cameras' clocks
+    are ahead of UTC, such as for the local timezone. Returns the number of
+    sessions matched."""
+    segments = sorted(segments, key=lambda segment: segment.start_time)
+    starts = numpy.array([segment.start_time for segment in segments])
+    # Segments from different logs may overlap, so a segment ending before
+    # the session starts may come after one which doesn't.
+    latest_ends = numpy.maximum.accumulate(
+        [segment.end_time for segment in segments] or [0])
+
+    matched = 0
+    for session in sessions:
+        if 'start_time' not in session or 'duration' not in session:
+            continue
+        start = session['start_time'] - clock_offset
+        end = start + session['duration']
+
+        # Only the segments starting before the session ends, and after the
+        # last one to end before the session started, can overlap it.
+        first = numpy.searchsorted(latest_ends, start, side="right")
+        last = numpy.searchsorted(starts, end, side="left")
+
+        best = None
+        for segment in segments[first:last]:
+            overlap = min(end, segment.end_time) - max(start, segment.start_time)
+            if overlap > 0 and (best is None or overlap > best[0]):
+                best = (overlap, segment)
+
+        if best is not None:
+            segment = best[1]
+            session['log'] = {
+                "path": segment.log.path,
+                "start_time": float(segment.start_time),
+                "end_time": float(segment.end_time),
+                # How many seconds into the log segment the session starts.
+                "offset": float(start - segment.start_time),
+            }
+            matched += 1
+
+    return matched
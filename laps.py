@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Lap detection from GPS logs.
+
+Laps are timed from each crossing of a start/finish line, either given or
+picked automatically, to the next. Every step of the GPS trace is tested
+for crossing the line at once with numpy, and the time of each crossing is
+interpolated between the fixes either side of it.
+"""
+
+import math
+import argparse
+
+import numpy
+
+import sessionstore
+
+EARTH_RADIUS = 6371000.0
+
+# Width in metres of an automatically placed start/finish line.
+LINE_WIDTH = 30.0
+
+# Crossings closer together than this many seconds are GPS noise around the
+# line rather than laps.
+MIN_LAP_TIME = 20.0
+
+def project(latitude, longitude, origin):
+    """Return x and y in metres east and north of origin, a (latitude,
+    longitude) tuple. An equirectangular projection is accurate enough over
+    the size of a circuit."""
+    scale = math.radians(1) * EARTH_RADIUS
+    x = (numpy.asarray(longitude) - origin[1]) * scale * math.cos(math.radians(origin[0]))
+    y = (numpy.asarray(latitude) - origin[0]) * scale
+    return (x, y)
+
+def unproject(x, y, origin):
+    scale = math.radians(1) * EARTH_RADIUS
+    return (origin[0] + y / scale,
+        origin[1] + x / (scale * math.cos(math.radians(origin[0]))))
+
+def parse_line(value):
+    """Parse a start/finish line given as "lat1,lon1,lat2,lon2"."""
+    values = [float(part) for part in value.split(",")]
+    if len(values) != 4:
+        raise ValueError("A start/finish line needs two latitude, longitude pairs")
+    return tuple(values)
+
+def find_start_finish(log, start=0, end=None, width=LINE_WIDTH):
+    """Return a start/finish line across the track where the fixes from
+    start to end in log are fastest, which is usually on the main straight.
+    The line is returned as a (lat1, lon1, lat2, lon2) tuple."""
+    if end is None:
+        end = len(log)
+    speed = log.speed[start:end]
+    if end - start < 3:
+        return None
+
+    # Ignore the first and last fixes so there's a fix either side to get
+    # the heading from.
+    i = start + 1 + int(numpy.argmax(speed[1:-1]))
+    origin = (log.latitude[i], log.longitude[i])
+    (x, y) = project(log.latitude[i - 1:i + 2], log.longitude[i - 1:i + 2], origin)
+    heading = numpy.array([x[2] - x[0], y[2] - y[0]])
+    length = numpy.hypot(*heading)
+    if length == 0:
+        return None
+
+    # Perpendicular to the direction of travel, centred on the fix.
+    normal = numpy.array([-heading[1], heading[0]]) / length * width / 2
+    (lat1, lon1) = unproject(-normal[0], -normal[1], origin)
+    (lat2, lon2) = unproject(normal[0], normal[1], origin)
+    return (lat1, lon1, lat2, lon2)
+
+def find_crossings(times, latitude, longitude, line):
+    """Return the times at which the trace of fixes crosses line, in the
+    direction the trace crosses it most often. Times are interpolated
+    between the fixes either side of each crossing."""
+    origin = ((line[0] + line[2]) / 2, (line[1] + line[3]) / 2)
+    (x, y) = project(latitude, longitude, origin)
+    (ax, ay) = project(line[0], line[1], origin)
+    (bx, by) = project(line[2], line[3], origin)
+    (ex, ey) = (bx - ax, by - ay)
+
+    # Each step of the trace is the segment from one fix to the next. It
+    # crosses the line where p + t * d == a + u * e for 0 <= t < 1 and
+    # 0 <= u <= 1.
+    dx = numpy.diff(x)
+    dy = numpy.diff(y)
+    px = ax - x[:-1]
+    py = ay - y[:-1]
+    denominator = dx * ey - dy * ex
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = (px * ey - py * ex) / denominator
+        u = (px * dy - py * dx) / denominator
+    hits = (denominator != 0) & (t >= 0) & (t < 1) & (u >= 0) & (u <= 1)
+
+    # The sign of the denominator is the direction of the crossing.
+    forwards = hits & (denominator > 0)
+    backwards = hits & (denominator < 0)
+    if numpy.count_nonzero(backwards) > numpy.count_nonzero(forwards):
+        forwards = backwards
+
+    steps = numpy.flatnonzero(forwards)
+    return times[steps] + t[steps] * (times[steps + 1] - times[steps])
+
+def get_laps(crossings, min_lap_time=MIN_LAP_TIME):
+    """Return a list of (start, end) times of the laps between crossings."""
+    kept = []
+    for crossing in crossings:
+        if not kept or crossing - kept[-1] >= min_lap_time:
+            kept.append(crossing)
+    return zip(kept[:-1], kept[1:])
+
+def add_laps(session, log, line):
+    """Detect the laps in the part of log matched with session which has
+    video, and record them in the session's laps, with their times in
+    seconds from the start of the session and in milliseconds into each
+    view's recording. Laps which weren't filmed from start to finish are
+    left out."""
+    # Where the session's timeline starts and ends, in the log's time.
+    session_start = session['log']['start_time'] + session['log']['offset']
+    session_end = session_start + session['duration']
+
+    (start, end) = log.get_range(
+        max(session['log']['start_time'], session_start),
+        min(session['log']['end_time'], session_end))
+    crossings = find_crossings(log.times[start:end + 1],
+        log.latitude[start:end + 1], log.longitude[start:end + 1], line)
+    # The fix after the end of the range may put a crossing just past it.
+    crossings = crossings[crossings <= session_end]
+
+    laps = []
+    for (number, (lap_start, lap_end)) in enumerate(get_laps(crossings), 1):
+        lap = {
+            "lap": number,
+            "start_time": float(lap_start),
+            "end_time": float(lap_end),
+            "lap_time": float(lap_end - lap_start),
+            "start": float(lap_start - session_start),
+            "end": float(lap_end - session_start),
+            "views": {},
+        }
+        for (camera, view) in session['views'].items():
+            offset = view.get('offset', 0)
+            lap['views'][camera] = {
+                "start": int(round(lap['start'] * 1000 + offset)),
+                "end": int(round(lap['end'] * 1000 + offset)),
+            }
+        laps.append(lap)
+
+    session['laps'] = laps
+    session['start_finish'] = [float(value) for value in line]
+    return laps
+
+def get_best_lap(session):
+    """Return the fastest lap of session, or None if it has no laps."""
+    laps = session.get('laps', [])
+    if not laps:
+        return None
+    return min(laps, key=lambda lap: lap['lap_time'])
+
+def format_lap_time(seconds):
+    return "%d:%06.3f" % (seconds // 60, seconds % 60)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the lap table of each session.")
+    parser.add_argument("--path", action="store", default="sessions.yaml")
+    parser.add_argument("--index", action="append", type=int, default=[],
+        help="Only show this session. May be given more than once, defaults "
+        "to every session.")
+    args = parser.parse_args()
+
+    store = sessionstore.open_sessions(args.path)
+    for index in args.index or range(len(store)):
+        session = store[index]
+        laps = session.get('laps')
+        if not laps:
+            continue
+
+        best = get_best_lap(session)
+        print "Session %d" % index
+        print "%4s %10s %10s %10s" % ("Lap", "Start", "End", "Time")
+        for lap in laps:
+            print "%4d %10.3f %10.3f %10s%s" % (lap['lap'], lap['start'],
+                lap['end'], format_lap_time(lap['lap_time']),
+                " *" if lap is best else "")
+        print
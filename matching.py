@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Signature matching between segments from different cameras.
+
+Segments are indexed by the intervals between their HiLight tags, so that
+finding candidate matches for a segment only involves looking up a handful of
+buckets rather than comparing it with every other segment. Candidates are
+then aligned by finding the offset that lines up the most tags, which allows
+for a tag that was registered by one camera and missed by another.
+"""
+
+import collections
+
+import numpy
+
+# Tags registered by different cameras for the same button press on a remote
+# should land within this many milliseconds of each other.
+TOLERANCE_MS = 250
+
+# Width of the buckets that tag intervals are quantized into for indexing.
+QUANTUM_MS = 500
+
+# Index intervals between tags up to this many tags apart, so that a missing
+# or extra tag still leaves some intervals in common.
+MAX_SKIP = 2
+
+# At least this many tags need to line up for a match to be considered.
+MIN_MATCHED_TAGS = 2
+
+Match = collections.namedtuple("Match", ["offset", "confidence", "error"])
+
+def get_intervals(tags):
+    """Return an array of the intervals between each tag and the next
+    MAX_SKIP tags."""
+    tags = numpy.asarray(tags, dtype=numpy.int64)
+    intervals = [tags[skip:] - tags[:-skip] for skip in range(1, MAX_SKIP + 1)
+        if skip < len(tags)]
+    if len(intervals) == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    return numpy.concatenate(intervals)
+
+def align(tags, other_tags, tolerance=TOLERANCE_MS):
+    """Find the offset which, when added to tags, lines up the most tags with
+    other_tags. Returns a Match, or None if not enough tags line up."""
+    tags = numpy.asarray(tags, dtype=numpy.int64)
+    other_tags = numpy.asarray(other_tags, dtype=numpy.int64)
+    if len(tags) == 0 or len(other_tags) == 0:
+        return None
+
+    # Every pairing of one tag from each segment suggests an offset. The true
+    # offset is the one suggested (within the tolerance) by the most pairs.
+    offsets = numpy.sort((other_tags[None, :] - tags[:, None]).ravel())
+    window_ends = numpy.searchsorted(offsets, offsets + tolerance, side="right")
+    counts = window_ends - numpy.arange(len(offsets))
+
+    best = int(numpy.argmax(counts))
+    matched = int(counts[best])
+    if matched < MIN_MATCHED_TAGS:
+        return None
+
+    window = offsets[best:window_ends[best]]
+    offset = int(numpy.median(window))
+    error = float(numpy.mean(numpy.abs(window - offset)))
+    confidence = min(1.0, matched / float(max(len(tags), len(other_tags))))
+
+    return Match(offset, confidence, error)
+
+class SignatureIndex(object):
+    def __init__(self, quantum=QUANTUM_MS):
+        self.quantum = quantum
+        self.buckets = collections.defaultdict(set)
+        self.tags = {}
+
+    def add(self, key, tags):
+        if len(tags) < 2:
+            # Nothing to index without at least one interval.
+            return
+
+        self.tags[key] = numpy.asarray(tags, dtype=numpy.int64)
+        for bucket in numpy.unique(get_intervals(tags) // self.quantum):
+            self.buckets[int(bucket)].add(key)
+
+    def remove(self, key):
+        tags = self.tags.pop(key, None)
+        if tags is None:
+            return
+        for bucket in numpy.unique(get_intervals(tags) // self.quantum):
+            self.buckets[int(bucket)].discard(key)
+
+    def candidates(self, tags):
+        """Return the keys of everything in the index that shares at least
+        one tag interval with tags."""
+        found = set()
+        for bucket in numpy.unique(get_intervals(tags) // self.quantum):
+            # Look in the neighbouring buckets too, as an interval near the
+            # edge of a bucket may have been quantized into the next one.
+            for neighbour in (bucket - 1, bucket, bucket + 1):
+                found.update(self.buckets.get(int(neighbour), ()))
+        return found
+
+    def match(self, tags):
+        """Yield (key, Match) tuples for each candidate in the index that
+        lines up with tags."""
+        for key in self.candidates(tags):
+            match = align(tags, self.tags[key])
+            if match is not None:
+                yield (key, match)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""On-disk cache of per-file segment metadata.
+
+Extracting tags from every video on every run of assemble.py is slow for a
+large archive, so the results are kept in a small SQLite database and reused
+for files that haven't changed.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+
+import profiling
+
+# Bump this whenever the structure of the cached metadata changes, which
+# invalidates everything previously cached.
+CACHE_VERSION = 3
+
+# How many bytes to read from each sampled block of a file when
+# fingerprinting it.
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# How many blocks to sample, spread evenly from the start to the end of the
+# file. The first and last blocks hold the MP4 headers and the moov box with
+# the tags, the ones between are from the encoded video.
+FINGERPRINT_BLOCKS = 4
+
+def get_fingerprint(path, size=None):
+    """Return a cheap fingerprint of the file at path, made by hashing the
+    file size along with a few blocks sampled at fixed points in the file.
+    Only FINGERPRINT_BLOCKS * FINGERPRINT_BLOCK_SIZE bytes are read however
+    large the file is."""
+    if size is None:
+        size = os.path.getsize(path)
+
+    digest = hashlib.sha1(str(size))
+    with profiling.open_file(path) as f:
+        last = max(0, size - FINGERPRINT_BLOCK_SIZE)
+        position = 0
+        for block in range(FINGERPRINT_BLOCKS):
+            start = last * block // (FINGERPRINT_BLOCKS - 1)
+            # Small files would have overlapping blocks, don't read any of
+            # the file twice.
+            start = max(start, position)
+            if start >= size:
+                break
+            if start != position:
+                f.seek(start)
+            data = f.read(FINGERPRINT_BLOCK_SIZE)
+            digest.update(data)
+            position = start + len(data)
+    profiling.count("fingerprints")
+    return digest.hexdigest()
+
+class MetadataCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Fingerprints computed by get() for files that missed the cache, so
+        # that put() doesn't need to read the files again.
+        self.fingerprints = {}
+
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != CACHE_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute("PRAGMA user_version = %d" % CACHE_VERSION)
+
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            fingerprint TEXT,
+            metadata TEXT)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS files_fingerprint
+            ON files (size, fingerprint)""")
+        self.db.commit()
+
+    def get(self, path):
+        """Return the cached metadata for the file at path, or None if there
+        is none or the file has changed since it was cached."""
+        st = os.stat(path)
+
+        row = self.db.execute("SELECT size, mtime, metadata FROM files "
+            "WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            (size, mtime, metadata) = row
+            if size == st.st_size and mtime == st.st_mtime:
+                # Unchanged since it was cached, no need to open the file.
+                return json.loads(metadata)
+
+        # The file is new or has been touched. It may just have been copied
+        # or moved, in which case its content will match something already
+        # in the cache.
+        fingerprint = self.get_fingerprint(path, st)
+        row = self.db.execute("SELECT metadata FROM files "
+            "WHERE size = ? AND fingerprint = ?",
+            (st.st_size, fingerprint)).fetchone()
+        if row is None:
+            return None
+
+        metadata = json.loads(row[0])
+        self.put(path, metadata, fingerprint)
+        return metadata
+
+    def get_fingerprint(self, path, st=None):
+        """Return the fingerprint of the file at path, only reading the file
+        if it has changed since it was cached or last fingerprinted."""
+        if st is None:
+            st = os.stat(path)
+
+        if path in self.fingerprints:
+            (size, mtime, fingerprint) = self.fingerprints[path]
+            if (size, mtime) == (st.st_size, st.st_mtime):
+                return fingerprint
+
+        row = self.db.execute("SELECT size, mtime, fingerprint FROM files "
+            "WHERE path = ?", (path,)).fetchone()
+        if row is not None and tuple(row[:2]) == (st.st_size, st.st_mtime):
+            return row[2]
+
+        fingerprint = get_fingerprint(path, st.st_size)
+        self.fingerprints[path] = (st.st_size, st.st_mtime, fingerprint)
+        return fingerprint
+
+    def put(self, path, metadata, fingerprint=None):
+        st = os.stat(path)
+        if fingerprint is None:
+            (size, mtime, fingerprint) = self.fingerprints.pop(path, (None, None, None))
+            if (size, mtime) != (st.st_size, st.st_mtime):
+                fingerprint = get_fingerprint(path, st.st_size)
+
+        self.db.execute("INSERT OR REPLACE INTO files "
+            "(path, size, mtime, fingerprint, metadata) VALUES (?, ?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime, fingerprint, json.dumps(metadata)))
+
+    def prune(self):
+        """Forget about any cached files that no longer exist."""
+        stale = [(path,) for (path,) in self.db.execute("SELECT path FROM files")
+            if not os.path.exists(path)]
+        self.db.executemany("DELETE FROM files WHERE path = ?", stale)
+
+    def clear(self):
+        self.db.execute("DELETE FROM files")
+
+    def save(self):
+        self.db.commit()
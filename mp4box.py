@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""Minimal MP4 box reader.
+
+Rather than building a tree of every atom in the file, this walks box headers
+directly and seeks past anything it isn't interested in, so the number of
+reads needed to find a box depends on the depth of the path to it rather than
+on the size of the file.
+"""
+
+import os
+import mmap
+import struct
+
+import profiling
+
+# Seconds between the MP4 epoch, 1904-01-01, and the Unix epoch.
+MP4_EPOCH_OFFSET = 2082844800
+
+def iter_boxes(f, start, end):
+    """Yield (box_type, payload_offset, payload_size) for each box found
+    between the offsets start and end in the file-like object f."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        (size, box_type) = struct.unpack(">I4s", header)
+        header_size = 8
+
+        if size == 1:
+            # A 64 bit 'largesize' follows the box type, used for boxes
+            # larger than 4GB such as the mdat on long recordings.
+            largesize = f.read(8)
+            if len(largesize) < 8:
+                return
+            (size,) = struct.unpack(">Q", largesize)
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of its container.
+            size = end - offset
+
+        if size < header_size:
+            # Corrupt or truncated box, nothing beyond this can be trusted.
+            return
+
+        yield (box_type, offset + header_size, size - header_size)
+        offset += size
+
+def find_box(f, box_path, start=0, end=None):
+    """Follow box_path (a list of box types such as ["moov", "udta"]) down
+    from the container spanning start to end. Returns a tuple of
+    (payload_offset, payload_size) for the last box in the path, or None if
+    any box along the path is missing."""
+    if end is None:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+
+    for box_type in box_path:
+        for (found_type, payload_offset, payload_size) in iter_boxes(f, start, end):
+            if found_type == box_type:
+                start = payload_offset
+                end = payload_offset + payload_size
+                break
+        else:
+            return None
+
+    return (start, end - start)
+
+def read_box_payload(path, box_path, use_mmap=False):
+    """Return the payload bytes of the box at box_path in the file at path,
+    or None if there is no such box."""
+    with profiling.open_file(path) as f:
+        if use_mmap:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            source = f
+
+        try:
+            location = find_box(source, box_path)
+            if location is None:
+                return None
+
+            (payload_offset, payload_size) = location
+            source.seek(payload_offset)
+            return source.read(payload_size)
+        finally:
+            if use_mmap:
+                source.close()
+
+def _read_time_header(f, payload_offset):
+    """Return (timescale, duration) from an mvhd or mdhd box payload."""
+    f.seek(payload_offset)
+    (version,) = struct.unpack(">B", f.read(1))
+    if version == 1:
+        # 64 bit creation and modification times, 64 bit duration.
+        f.seek(payload_offset + 4 + 16)
+        return struct.unpack(">IQ", f.read(12))
+    else:
+        f.seek(payload_offset + 4 + 8)
+        return struct.unpack(">II", f.read(8))
+
+def _read_creation_time(f, payload_offset):
+    """Return the creation time from an mvhd or mdhd box payload in seconds
+    since the Unix epoch, or None if it isn't set."""
+    f.seek(payload_offset)
+    (version,) = struct.unpack(">B", f.read(1))
+    f.seek(payload_offset + 4)
+    if version == 1:
+        (creation_time,) = struct.unpack(">Q", f.read(8))
+    else:
+        (creation_time,) = struct.unpack(">I", f.read(4))
+
+    if creation_time == 0:
+        return None
+    return creation_time - MP4_EPOCH_OFFSET
+
+def _read_time_to_sample(f, payload_offset):
+    """Return the (sample_count, sample_delta) entries of an stts box."""
+    f.seek(payload_offset + 4)
+    (entry_count,) = struct.unpack(">I", f.read(4))
+    entries = struct.unpack(">" + ("II" * entry_count), f.read(8 * entry_count))
+    return zip(entries[0::2], entries[1::2])
+
+def _count_samples(f, payload_offset):
+    """Return the total number of samples listed in an stts box."""
+    return sum(count for (count, delta) in _read_time_to_sample(f, payload_offset))
+
+def _read_sync_samples(f, payload_offset):
+    """Return the 1-based numbers of the sync samples (keyframes) listed in
+    an stss box."""
+    f.seek(payload_offset + 4)
+    (entry_count,) = struct.unpack(">I", f.read(4))
+    return struct.unpack(">" + ("I" * entry_count), f.read(4 * entry_count))
+
+def _find_video_track(f):
+    """Return (trak_offset, trak_end) for the first video track in f, or None
+    if there isn't one."""
+    f.seek(0, os.SEEK_END)
+    moov = find_box(f, ["moov"], 0, f.tell())
+    if moov is None:
+        return None
+    (moov_offset, moov_size) = moov
+
+    for (box_type, trak_offset, trak_size) in \
+            iter_boxes(f, moov_offset, moov_offset + moov_size):
+        if box_type != "trak":
+            continue
+        trak_end = trak_offset + trak_size
+
+        hdlr = find_box(f, ["mdia", "hdlr"], trak_offset, trak_end)
+        if hdlr is None:
+            continue
+        # Skip version, flags and pre_defined to get the handler type.
+        f.seek(hdlr[0] + 8)
+        if f.read(4) == "vide":
+            return (trak_offset, trak_end)
+
+    return None
+
+def probe_video(path):
+    """Return a dict describing the first video track in the file at path,
+    with the keys frames, timescale, duration (in seconds), fps and
+    creation_time (in seconds since the Unix epoch, by the camera's clock, or
+    None). Returns None if the file doesn't have a video track that can be
+    parsed."""
+    with profiling.open_file(path) as f:
+        track = _find_video_track(f)
+        if track is None:
+            return None
+        (trak_offset, trak_end) = track
+
+        mdhd = find_box(f, ["mdia", "mdhd"], trak_offset, trak_end)
+        stts = find_box(f, ["mdia", "minf", "stbl", "stts"],
+            trak_offset, trak_end)
+        if mdhd is None or stts is None:
+            return None
+
+        (timescale, duration) = _read_time_header(f, mdhd[0])
+        frames = _count_samples(f, stts[0])
+        if timescale == 0 or duration == 0:
+            return None
+
+        return {
+            "frames": frames,
+            "timescale": timescale,
+            "duration": duration / float(timescale),
+            "fps": frames * timescale / float(duration),
+            "creation_time": _read_creation_time(f, mdhd[0]),
+        }
+
+def read_sample_tables(path):
+    """Return a dict of the sample tables of the first video track in the
+    file at path, or None if it can't be parsed. The keys are timescale,
+    stts, a list of (sample_count, sample_delta) tuples, and stss, the
+    1-based numbers of the keyframes or None if every frame is a
+    keyframe."""
+    with profiling.open_file(path) as f:
+        track = _find_video_track(f)
+        if track is None:
+            return None
+        (trak_offset, trak_end) = track
+
+        stbl = find_box(f, ["mdia", "minf", "stbl"], trak_offset, trak_end)
+        mdhd = find_box(f, ["mdia", "mdhd"], trak_offset, trak_end)
+        if stbl is None or mdhd is None:
+            return None
+        (stbl_offset, stbl_size) = stbl
+
+        stts = find_box(f, ["stts"], stbl_offset, stbl_offset + stbl_size)
+        if stts is None:
+            return None
+        stts = _read_time_to_sample(f, stts[0])
+
+        # Without an stss box, every sample is a sync sample.
+        stss = find_box(f, ["stss"], stbl_offset, stbl_offset + stbl_size)
+        if stss is not None:
+            stss = _read_sync_samples(f, stss[0])
+
+        (timescale, duration) = _read_time_header(f, mdhd[0])
+        if timescale == 0:
+            return None
+
+        return {
+            "timescale": timescale,
+            "stts": stts,
+            "stss": stss,
+        }
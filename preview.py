@@ -1,10 +1,14 @@
 #!/usr/bin/env python
-import yaml
+import proxies
+import seekindex
+import sessionstore
 
 import gtk
 gtk.gdk.threads_init()
+import gobject
 
 import sys
+import time
 import vlc
 
 from gettext import gettext as _
@@ -32,6 +36,7 @@ class VLCWidget(gtk.DrawingArea):
 
 class DecoratedVLCWidget(gtk.VBox):
     offset = None
+    seek_index = None
 
     def __init__(self, videoplayers):
         gtk.VBox.__init__(self)
@@ -63,6 +68,11 @@ class DecoratedVLCWidget(gtk.VBox):
         labelcontainer.add(self.offset_widget)
         tb.insert(labelcontainer, -1)
 
+        self.frame_widget = gtk.Label()
+        labelcontainer = gtk.ToolItem()
+        labelcontainer.add(self.frame_widget)
+        tb.insert(labelcontainer, -1)
+
         #tb.insert(self.offset_widget, -1)
         tb.show_all()
         return tb
@@ -83,6 +93,154 @@ class DecoratedVLCWidget(gtk.VBox):
 
         self.offset_widget.set_text(offset_label)
 
+    def seek(self, ms, snap=True):
+        """Seek to ms into this video. If there's a seek index and snap is
+        True, seek to the nearest keyframe instead, which is much quicker,
+        and show exactly which frame that is."""
+        ms = max(0, ms)
+        if self.seek_index is not None:
+            if snap:
+                (frame, keyframe_ms) = self.seek_index.nearest_keyframe(ms)
+                self.frame_widget.set_text("Frame %d (%+dms)" % (frame,
+                    keyframe_ms - ms))
+                ms = keyframe_ms
+            else:
+                self.frame_widget.set_text("Frame %d" %
+                    self.seek_index.frame_at(ms))
+        self.player.set_time(int(ms))
+
+    def get_frame_length(self):
+        """Return the length of a frame in milliseconds."""
+        if self.seek_index is None or len(self.seek_index) == 0:
+            return 1000.0 / 30
+        return self.seek_index.duration() / len(self.seek_index)
+
+class SyncController(object):
+    """Keeps several players in sync with a single clock.
+
+    The clock gives the position in the session, and each player should be at
+    that position plus its offset. While playing, each player's position is
+    checked regularly and its rate nudged to close any drift, or it is seeked
+    back into place if it's too far out.
+    """
+
+    # Milliseconds between drift checks.
+    CHECK_INTERVAL = 500
+
+    # Drift is closed over this many seconds by adjusting the rate.
+    CORRECTION_TIME = 2.0
+
+    # Players which have drifted by more than this many milliseconds are
+    # seeked back into place instead.
+    MAX_DRIFT = 1000
+
+    def __init__(self, videoplayers, rate=1.0):
+        self.videoplayers = videoplayers
+        self.rate = rate
+        self.playing = False
+        self.preparing = set()
+
+        # The session position in milliseconds at the wall clock time the
+        # clock was last started or moved.
+        self.origin_position = 0.0
+        self.origin_time = time.time()
+
+    def position(self):
+        """Return the current position in the session in milliseconds."""
+        if not self.playing:
+            return self.origin_position
+        return self.origin_position + (time.time() - self.origin_time) * 1000 * self.rate
+
+    def set_position(self, position):
+        self.origin_position = max(0.0, position)
+        self.origin_time = time.time()
+
+    def expected_time(self, v):
+        return self.position() + (v.offset or 0)
+
+    def prepare(self, *args):
+        """Start every player so that its video is loaded, and pause each as
+        soon as VLC reports it has started playing."""
+        self.preparing = set(self.videoplayers.values())
+        for v in self.preparing:
+            v.player.audio_set_mute(True)
+            v.player.event_manager().event_attach(
+                vlc.EventType.MediaPlayerPlaying, self._on_playing, v)
+        for v in list(self.preparing):
+            v.player.play()
+
+    def _on_playing(self, event, v):
+        # Called from a VLC thread, so hand over to the GTK main loop.
+        gobject.idle_add(self._prepared, v)
+
+    def _prepared(self, v):
+        if v in self.preparing:
+            v.player.event_manager().event_detach(vlc.EventType.MediaPlayerPlaying)
+            v.player.set_pause(True)
+            v.player.audio_set_mute(False)
+            self.preparing.discard(v)
+            if not self.preparing:
+                self.seek(self.position())
+        return False
+
+    def play(self, *args):
+        if self.playing:
+            return
+        position = self.position()
+        for v in self.videoplayers.values():
+            v.player.set_rate(self.rate)
+            v.seek(position + (v.offset or 0), snap=False)
+        # Start every player at once, then start the clock.
+        for v in self.videoplayers.values():
+            v.player.play()
+        self.set_position(position)
+        self.playing = True
+        gobject.timeout_add(self.CHECK_INTERVAL, self.correct_drift)
+
+    def pause(self, *args):
+        if not self.playing:
+            return
+        position = self.position()
+        self.playing = False
+        self.set_position(position)
+        for v in self.videoplayers.values():
+            v.player.set_pause(True)
+
+    def stop(self, *args):
+        self.pause()
+        self.seek(0)
+
+    def seek(self, position):
+        """Move every player to position in the session. While paused, each
+        snaps to its nearest keyframe so that scrubbing is quick."""
+        self.set_position(position)
+        for v in self.videoplayers.values():
+            v.seek(self.expected_time(v), snap=not self.playing)
+
+    def correct_drift(self):
+        if not self.playing:
+            return False
+
+        for v in self.videoplayers.values():
+            actual = v.player.get_time()
+            if actual < 0 or not v.player.is_playing():
+                continue
+
+            drift = actual - self.expected_time(v)
+            if abs(drift) > self.MAX_DRIFT:
+                v.seek(self.expected_time(v), snap=False)
+                v.player.set_rate(self.rate)
+            elif abs(drift) > v.get_frame_length():
+                # Play faster or slower for a while to close the gap, but
+                # not so much that it's noticeable.
+                rate = self.rate - drift / (self.CORRECTION_TIME * 1000)
+                v.player.set_rate(min(max(rate, self.rate * 0.9), self.rate * 1.1))
+            else:
+                v.player.set_rate(self.rate)
+
+        # Keep checking for as long as we're playing.
+        return True
+
 class VideoPlayer:
     """Example simple video player.
     """
@@ -109,19 +267,20 @@ class MultiVideoPlayer:
         window.add(mainbox)
         mainbox.add(videos)
     
-        paths = []
+        # Low res versions for speed, where there are any.
+        session = proxies.use_proxies(session)
+
         for camera, view in session['views'].items():
             path = view['paths'][0]
-            
-            # Low res versions for speed. TODO make this configurable
-            path = path.replace(".MP4", ".LRV")
 
             v = DecoratedVLCWidget(self.videoplayers)
+            v.seek_index = seekindex.get_seek_index(path)
             v.player.set_media(instance.media_new(path))
-            v.player.set_rate(0.5)
             self.videoplayers[camera] = v
             videos.add(v)
 
+        self.controller = SyncController(self.videoplayers, rate=0.5)
+
         # Set the offsets after creating all the videos because the offsets
         # are computed relative to the fixed video.
         for camera, view in session['views'].items():
@@ -131,52 +290,41 @@ class MultiVideoPlayer:
         tb = gtk.Toolbar()
         tb.set_style(gtk.TOOLBAR_ICONS)
 
-        def execute(b, methodname):
-            """Execute the given method on all VLC widgets.
-            """
-            for v in videos.get_children():
-                getattr(v.player, methodname)()
-            return True
-
-        for text, tooltip, stock, callback, arg in (
-            (_("Play"), _("Global play"), gtk.STOCK_MEDIA_PLAY, execute, "play"),
-            (_("Pause"), _("Global pause"), gtk.STOCK_MEDIA_PAUSE, execute, "pause"),
-            (_("Stop"), _("Global stop"), gtk.STOCK_MEDIA_STOP, execute, "stop"),
+        for text, tooltip, stock, callback in (
+            (_("Play"), _("Global play"), gtk.STOCK_MEDIA_PLAY, self.controller.play),
+            (_("Pause"), _("Global pause"), gtk.STOCK_MEDIA_PAUSE, self.controller.pause),
+            (_("Stop"), _("Global stop"), gtk.STOCK_MEDIA_STOP, self.controller.stop),
             ):
             b = gtk.ToolButton(stock)
             b.set_tooltip_text(tooltip)
-            b.connect("clicked", callback, arg)
+            b.connect("clicked", callback)
             tb.insert(b, -1)
         
         b = gtk.ToolButton()
         b.set_label("Load videos")
-        b.connect("clicked", self.load_videos)
+        b.connect("clicked", self.controller.prepare)
         tb.insert(b, 0)
 
         mainbox.pack_start(tb, expand=False)
 
+        # Scrub through the whole session, keeping the videos in sync.
+        length = max([v.seek_index.duration() for v in self.videoplayers.values()
+            if v.seek_index is not None] or [0])
+        scrubber = gtk.HScale(gtk.Adjustment(0, 0, length, 1000, 10000))
+        scrubber.set_draw_value(False)
+        scrubber.connect("value-changed", self.scrub)
+        mainbox.pack_start(scrubber, expand=False)
+
         window.show_all()
         window.connect("destroy", gtk.main_quit)
         gtk.main()
 
-    
-    def load_videos(self, toolbutton):
-        for camera, v in self.videoplayers.items():
-            v.player.play()
-            while not v.player.is_playing():
-                pass
-            v.player.pause()
-            while v.player.is_playing():
-                pass
-            
-            if v.offset is None:
-                v.player.set_time(0)
-            else:
-                v.player.set_time(int(v.offset))
+
+    def scrub(self, scale):
+        self.controller.seek(scale.get_value())
 
 if __name__ == "__main__":
-    sessions = yaml.load(open("sessions.yaml"))
-    session = sessions[int(sys.argv[1])]
+    session = sessionstore.open_sessions("sessions.yaml")[int(sys.argv[1])]
     import pprint
     pprint.pprint(session)
     mvp = MultiVideoPlayer()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Optional instrumentation of the time spent in each stage of the tools,
+the number of things processed and the I/O done on each file.
+
+Everything here does nothing until enable() is called, so instrumented code
+pays no more than a function call when profiling is off.
+"""
+
+import os
+import json
+import time
+import threading
+import collections
+
+enabled = False
+
+_lock = threading.Lock()
+_start = None
+_stages = collections.OrderedDict()
+_counters = collections.OrderedDict()
+_files = collections.OrderedDict()
+_events = []
+
+def enable():
+    global enabled, _start
+    enabled = True
+    _start = time.time()
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        wall = end - self.wall
+        # CPU time is for the whole process, so stages running concurrently
+        # in different threads will each include the others' CPU time.
+        cpu = _cpu_time() - self.cpu
+
+        with _lock:
+            stats = _stages.setdefault(self.name,
+                {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+
+            # Events in the Chrome trace event format, in microseconds.
+            _events.append({
+                "name": self.name,
+                "ph": "X",
+                "ts": int((self.wall - _start) * 1e6),
+                "dur": int(wall * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.current_thread().ident,
+            })
+        return False
+
+def stage(name):
+    """Return a context manager which times the code run within it as part
+    of the stage called name."""
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+def count(name, n=1):
+    """Add n to the counter called name."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+class _CountingFile(object):
+    """Wraps a file object, counting the reads and seeks done on it."""
+
+    def __init__(self, f, stats):
+        self._f = f
+        self._stats = stats
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        with _lock:
+            self._stats['reads'] += 1
+            self._stats['bytes_read'] += len(data)
+        return data
+
+    def seek(self, *args):
+        with _lock:
+            self._stats['seeks'] += 1
+        return self._f.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._f.close()
+        return False
+
+def open_file(path, mode="rb"):
+    """Open path like open(), counting the I/O done on the file if profiling
+    is enabled."""
+    f = open(path, mode)
+    if not enabled:
+        return f
+
+    with _lock:
+        stats = _files.setdefault(path,
+            {"opens": 0, "reads": 0, "bytes_read": 0, "seeks": 0})
+        stats['opens'] += 1
+    return _CountingFile(f, stats)
+
+def get_report():
+    with _lock:
+        return {
+            "wall": time.time() - _start,
+            "stages": dict(_stages),
+            "counters": dict(_counters),
+            "files": dict(_files),
+            # Lets the report be loaded directly into chrome://tracing.
+            "traceEvents": list(_events),
+        }
+
+def write_report(path):
+    open(path, "w").write(json.dumps(get_report(), indent=2, sort_keys=True))
+
+def start_cprofile():
+    """Start profiling the calling thread with cProfile."""
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_cprofile(profiler, path):
+    """Stop profiler and dump its stats to path for later analysis with
+    pstats."""
+    profiler.disable()
+    profiler.dump_stats(path)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Low resolution proxies for videos, used for previews and draft renders.
+
+GoPro cameras record a low resolution .LRV copy of each video alongside it.
+For cameras that don't, run this to transcode proxies into a cache directory
+and record them in sessions.yaml.
+"""
+
+import os
+import sys
+import copy
+import argparse
+import subprocess
+import multiprocessing
+import multiprocessing.pool
+
+import sessionstore
+
+PROXY_DIR = "proxies"
+
+# Height of transcoded proxies, similar to the LRV files from GoPro cameras.
+PROXY_HEIGHT = 360
+
+# ffmpeg threads given to each transcode.
+THREADS_PER_JOB = 2
+
+def get_lrv_path(path):
+    (base, ext) = os.path.splitext(path)
+    for proxy_ext in (".LRV", ".lrv"):
+        if os.path.exists(base + proxy_ext):
+            return base + proxy_ext
+    return None
+
+def get_cached_proxy_path(path, proxy_dir=PROXY_DIR):
+    """Return where the transcoded proxy for the video at path is kept. Each
+    camera's proxies are kept separately, as filenames repeat across
+    cameras."""
+    camera = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    (base, ext) = os.path.splitext(os.path.basename(path))
+    return os.path.join(proxy_dir, camera, base + ".mp4")
+
+def is_current(proxy_path, path):
+    """Return True if proxy_path exists and was made after path was last
+    modified."""
+    try:
+        return os.path.getmtime(proxy_path) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+def get_proxy_path(path, proxy_dir=PROXY_DIR):
+    """Return the path of the low resolution proxy for the video at path, or
+    None if it doesn't have one."""
+    lrv_path = get_lrv_path(path)
+    if lrv_path is not None:
+        return lrv_path
+
+    proxy_path = get_cached_proxy_path(path, proxy_dir)
+    if is_current(proxy_path, path):
+        return proxy_path
+    return None
+
+def build_proxy(path, proxy_path, threads=THREADS_PER_JOB):
+    """Transcode the video at path into a low resolution proxy at
+    proxy_path. Returns True if it succeeded."""
+    if not os.path.isdir(os.path.dirname(proxy_path)):
+        try:
+            os.makedirs(os.path.dirname(proxy_path))
+        except OSError:
+            # Another worker may have just created it.
+            pass
+
+    # Write to a temporary file first, so an interrupted transcode isn't
+    # mistaken for a current proxy.
+    partial_path = proxy_path + ".partial.mp4"
+    returncode = subprocess.call(["ffmpeg", "-v", "error", "-y", "-nostdin",
+        "-i", path, "-vf", "scale=-2:%d" % PROXY_HEIGHT,
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "28",
+        "-c:a", "aac", "-b:a", "64k", "-threads", str(threads), partial_path])
+    if returncode != 0:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return False
+
+    os.rename(partial_path, proxy_path)
+    return True
+
+def build_proxies(paths, proxy_dir=PROXY_DIR, jobs=None, threads=THREADS_PER_JOB):
+    """Build proxies for each of paths that doesn't already have a current
+    one, running up to jobs transcodes at once. Returns the number of
+    proxies built."""
+    if jobs is None:
+        jobs = max(1, multiprocessing.cpu_count() // threads)
+
+    missing = [path for path in paths if get_proxy_path(path, proxy_dir) is None]
+    print "Building %d proxies, %d at a time." % (len(missing), jobs)
+
+    def worker(path):
+        return (path, build_proxy(path, get_cached_proxy_path(path, proxy_dir),
+            threads))
+
+    # The work is done by ffmpeg, so threads are enough to keep the pool of
+    # processes busy.
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    built = 0
+    try:
+        for (path, ok) in pool.imap_unordered(worker, missing):
+            if ok:
+                built += 1
+                print "%s: done (%d/%d)" % (path, built, len(missing))
+            else:
+                print >> sys.stderr, "%s: ffmpeg failed" % path
+    finally:
+        pool.close()
+        pool.join()
+
+    return built
+
+def add_proxy_paths(session, proxy_dir=PROXY_DIR):
+    """Record the proxy for each video in session, or None where it has
+    none, in each view's proxy_paths. Returns True if anything changed."""
+    changed = False
+    for view in session['views'].values():
+        proxy_paths = [get_proxy_path(path, proxy_dir) for path in view['paths']]
+        if view.get('proxy_paths') != proxy_paths:
+            view['proxy_paths'] = proxy_paths
+            changed = True
+    return changed
+
+def use_proxies(session, proxy_dir=PROXY_DIR):
+    """Return a copy of session with each video replaced by its proxy where
+    it has one."""
+    session = copy.deepcopy(session)
+    for view in session['views'].values():
+        proxy_paths = view.pop('proxy_paths', None) or [None] * len(view['paths'])
+        paths = []
+        for (path, proxy_path) in zip(view['paths'], proxy_paths):
+            if proxy_path is None or not os.path.exists(proxy_path):
+                proxy_path = get_proxy_path(path, proxy_dir)
+            paths.append(proxy_path or path)
+        view['paths'] = paths
+    return session
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", action="store", default="sessions.yaml")
+    parser.add_argument("--proxy-dir", action="store", default=PROXY_DIR)
+    parser.add_argument("--jobs", action="store", type=int, default=None,
+        help="Transcodes to run at once. Defaults to one per %d cores." %
+        THREADS_PER_JOB)
+    parser.add_argument("--threads-per-job", action="store", type=int,
+        default=THREADS_PER_JOB)
+    args = parser.parse_args()
+
+    store = sessionstore.open_sessions(args.path)
+    sessions = store.export()
+
+    paths = []
+    for session in sessions:
+        for view in session['views'].values():
+            paths.extend(view['paths'])
+    build_proxies(paths, args.proxy_dir, args.jobs, args.threads_per_job)
+
+    changed = [index for (index, session) in enumerate(sessions)
+        if add_proxy_paths(session, args.proxy_dir)]
+    sessionstore.update_sessions(sessions, changed, args.path)
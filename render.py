@@ -3,13 +3,66 @@ import os
 import sys
 import argparse
 import collections
-import mlt
+import math
+import struct
 import hashlib
 import yaml
 import pprint
 import jinja2
 
-def get_video_details(path):
+# mlt is only needed to probe videos which can't be parsed directly.
+try:
+    import mlt
+except ImportError:
+    mlt = None
+
+import mp4box
+import metacache
+import profiling
+import renderqueue
+import proxies
+import sessionstore
+import laps
+
+def format_length(seconds):
+    """Format a duration like mlt's get_length_time()."""
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(int(minutes), 60)
+    return "%02d:%02d:%06.3f" % (hours, minutes, seconds)
+
+def probe_video_details(path):
+    """Read the video details straight from the MP4 container, which is much
+    faster than opening it with mlt."""
+    try:
+        probed = mp4box.probe_video(path)
+    except (IOError, struct.error):
+        return None
+
+    if probed is None or probed['frames'] < 1:
+        return None
+
+    return {
+        'frames': probed['frames'],
+        'length': format_length(probed['duration']),
+        'fps': probed['fps'],
+    }
+
+def get_video_details(path, cache=None):
+    if cache is not None:
+        details = cache.get(path)
+        if details is not None:
+            return details
+
+    # Only fall back to mlt for files the container can't be parsed from.
+    details = probe_video_details(path)
+    if details is None and mlt is not None:
+        details = get_mlt_video_details(path)
+
+    if details is not None and cache is not None:
+        cache.put(path, details)
+    return details
+
+def get_mlt_video_details(path):
     profile = mlt.Profile("quarter_ntsc")
     producer = mlt.Producer(profile, path)
 
@@ -31,60 +84,88 @@ def get_video_details(path):
     return details
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--path", action="store", default="sessions.yaml")
-parser.add_argument("--index", action="store", type=int, default=None, required=True)
-parser.add_argument("--length", action="store", type=int, default=None)
-parser.add_argument("--layout", action="store", default="front:inside:back")
-args = parser.parse_args()
-
-mlt.Factory.init()
-
-try:
-    session = yaml.load(open(args.path).read())[args.index]
-except Exception, ex:
-    print >> sys.stderr, "Failed to load session index %d from %s: %r" % (args.index, args.path, ex)
-    raise SystemExit(1)
-pprint.pprint(session)
-
-layout = args.layout.split(":")
-
-# Get number of frames in each video.
-video_details = {}
-for camera, view in session['views'].items():
-    for path in view['paths']:
-        video_details[path] = get_video_details(path)
-
-    # Convert an offset in milliseconds to a number of frames. Use the
-    # first video in a split series because the framerate won't change
-    # during a series.
-    try:
-        view['offset_frames'] = int(round(view['offset'] / (1000 / 
-            video_details.values()[0]['fps'])))
-    except (KeyError, ZeroDivisionError) as ex:
-        # No offset, or a zero offset.
-        pass
-
-# Filter videos and adjust the claimed length to match the command line args.
-if args.length:
+def add_offset_frames(session, video_details):
+    """Convert each view's offset in milliseconds to a number of frames."""
     for camera, view in session['views'].items():
-        print camera
-        frames = 0
+        # Use the first video in a split series because the framerate won't
+        # change during a series.
         try:
-            frames += view['offset_frames']
-        except KeyError:
+            view['offset_frames'] = int(round(view['offset'] / (1000 / 
+                video_details[view['paths'][0]]['fps'])))
+        except (KeyError, ZeroDivisionError) as ex:
+            # No offset, or a zero offset.
             pass
-    
-        for path in view['paths']:
-            frames_left = args.length - frames
-            print "This video provides %d frames, I have %d/%d left." % (video_details[path]['frames'], frames_left, args.length)
-            video_details[path]['frames'] = min(video_details[path]['frames'], frames_left)
-            frames += video_details[path]['frames']
 
-# TODO detect from the video lengths?
-last_frame = args.length
+def get_playlists(session, video_details, ranges):
+    """Work out which parts of each view's videos cover the (start, end)
+    frame ranges of the session's timeline in ranges, which are played one
+    after another. Returns a dict of camera name to a list of playlist items,
+    each either ("blank", frames) or ("entry", path, in, out) where in and out
+    are inclusive frame numbers within the video at path."""
+    playlists = {}
+    for camera, view in session['views'].items():
+        items = []
+
+        def add_blank(frames):
+            if frames <= 0:
+                return
+            if items and items[-1][0] == "blank":
+                items[-1] = ("blank", items[-1][1] + frames)
+            else:
+                items.append(("blank", frames))
+
+        for (start, end) in ranges:
+            # The frame of the session timeline each video starts at. A view's
+            # offset is how far into its recording the session starts, as in
+            # preview.py, so the first video starts before the timeline.
+            position = -view.get('offset_frames', 0)
+            covered = start
+
+            for path in view['paths']:
+                frames = video_details[path]['frames']
+                clip_start = max(start, position)
+                clip_end = min(end, position + frames)
+                if clip_start < clip_end:
+                    add_blank(clip_start - covered)
+                    items.append(("entry", path, clip_start - position,
+                        clip_end - position - 1))
+                    covered = clip_end
+                position += frames
+
+            # Fill the rest of the range so that every view stays in step
+            # for the next range.
+            add_blank(end - covered)
+
+        playlists[camera] = items
+    return playlists
+
+def get_highlight_ranges(session, video_details, pre_roll, post_roll):
+    """Return a sorted list of (start, end) frame ranges of the session's
+    timeline covering pre_roll seconds before to post_roll seconds after each
+    HiLight tag in any view, with overlapping ranges merged."""
+    session_frames = get_session_frames(session, video_details)
+
+    windows = []
+    for camera, view in session['views'].items():
+        fps = video_details[view['paths'][0]]['fps']
+        for tag in view.get('tags', []):
+            frame = int(round(tag * fps / 1000.0)) - view.get('offset_frames', 0)
+            windows.append((max(0, frame - int(pre_roll * fps)),
+                min(session_frames, frame + int(post_roll * fps))))
 
-template = """<?xml version="1.0" ?>
+    # The same press is usually tagged by several cameras, and presses close
+    # together should be one continuous cut.
+    ranges = []
+    for (start, end) in sorted(windows):
+        if start >= end:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+TEMPLATE = """<?xml version="1.0" ?>
 <mlt>
 {%- for camera, view in session.views.iteritems() %}
     <!-- {{ camera }} -->
@@ -95,13 +176,14 @@ template = """<?xml version="1.0" ?>
     {%- endfor %}
 {% endfor %}
 
-{%- for camera, view in session.views.iteritems() %}
+{%- for camera, playlist in playlists.iteritems() %}
     <playlist id="{{camera}}">
-    {%- if view.offset %}
-        <blank length="{{view.offset_frames}}" />
-    {%- endif %}
-    {%- for path in view.paths %}
-        <entry producer="{{camera}}:{{path}}" in="0" out="{{video_details[path].frames}}"/>
+    {%- for item in playlist %}
+        {%- if item[0] == "blank" %}
+        <blank length="{{item[1]}}" />
+        {%- else %}
+        <entry producer="{{camera}}:{{item[1]}}" in="{{item[2]}}" out="{{item[3]}}"/>
+        {%- endif %}
     {%- endfor %}
     </playlist>
 {% endfor %}
@@ -161,12 +243,335 @@ template = """<?xml version="1.0" ?>
 </mlt>
 """
 
-tmpl = jinja2.Template(template)
-xml = tmpl.render(session=session
-    ,   video_details=video_details
-    ,   last_frame=last_frame
-    ,   layout=layout
-    )
+def make_mlt(session, video_details, layout, ranges=None):
+    """Return the MLT XML describing the composite video made up of the
+    (start, end) frame ranges of session in ranges, which defaults to the
+    whole session."""
+    if ranges is None:
+        ranges = [(0, get_session_frames(session, video_details))]
+
+    tmpl = jinja2.Template(TEMPLATE)
+    return tmpl.render(session=session
+        ,   playlists=get_playlists(session, video_details, ranges)
+        ,   last_frame=sum(end - start for (start, end) in ranges) - 1
+        ,   layout=layout
+        )
+
+def get_session_frames(session, video_details):
+    """Return the length in frames of the longest view in session."""
+    lengths = [0]
+    for camera, view in session['views'].items():
+        frames = -view.get('offset_frames', 0)
+        for path in view['paths']:
+            frames += video_details[path]['frames']
+        lengths.append(frames)
+    return max(lengths)
+
+def get_session_video_details(session, probe_cache=None):
+    """Get the number of frames in each video in session, and convert the
+    offsets of its views to frames."""
+    video_details = {}
+    for camera, view in session['views'].items():
+        for path in view['paths']:
+            with profiling.stage("video_probe"):
+                video_details[path] = get_video_details(path, probe_cache)
+            profiling.count("files_probed")
+    add_offset_frames(session, video_details)
+    return video_details
+
+def get_window(session, video_details, start=0, length=None):
+    """Return the (start, end) frames of the part of session to render,
+    starting at frame start and lasting length frames or until the end of
+    the session."""
+    end = get_session_frames(session, video_details)
+    if length:
+        end = min(end, start + length)
+    return (min(start, end), end)
+
+def write_session_mlt(session, name, layout, start=0, length=None,
+        probe_cache=None):
+    """Write name.mlt covering length frames of session from frame start.
+    Returns the path written to and the number of frames it covers."""
+    video_details = get_session_video_details(session, probe_cache)
+    (start, end) = get_window(session, video_details, start, length)
+
+    path = name + ".mlt"
+    with profiling.stage("mlt_generation"):
+        xml = make_mlt(session, video_details, layout, [(start, end)])
+        open(path, "w").write(xml)
+
+    return (path, end - start)
+
+def write_highlights_mlt(session, name, layout, pre_roll, post_roll,
+        probe_cache=None):
+    """Write name.mlt containing only the parts of session around HiLight
+    tags. Returns the path written to and the number of frames it covers,
+    or None if the session has no HiLight tags."""
+    video_details = get_session_video_details(session, probe_cache)
+    ranges = get_highlight_ranges(session, video_details, pre_roll, post_roll)
+    if not ranges:
+        return None
+
+    path = name + ".mlt"
+    with profiling.stage("mlt_generation"):
+        xml = make_mlt(session, video_details, layout, ranges)
+        open(path, "w").write(xml)
+
+    return (path, sum(end - start for (start, end) in ranges))
+
+def get_lap_range(session, video_details, lap):
+    """Return the (start, end) frames of the session's timeline covering
+    lap, whose start and end are in seconds from the start of the session."""
+    # The views are all cut at the same frames, so any view's framerate will
+    # do.
+    view = session['views'].values()[0]
+    fps = video_details[view['paths'][0]]['fps']
+    end = get_session_frames(session, video_details)
+    return (max(0, int(round(lap['start'] * fps))),
+        min(end, int(round(lap['end'] * fps))))
+
+def write_laps_mlt(session, name, layout, best_only=False, probe_cache=None):
+    """Write name.lapN.mlt for each lap of session, or only name.bestlap.mlt
+    for its fastest lap if best_only is True. Returns a list of (name, mlt
+    path, frames) tuples."""
+    video_details = get_session_video_details(session, probe_cache)
+    if best_only:
+        best = laps.get_best_lap(session)
+        selected = [("%s.bestlap" % name, best)] if best is not None else []
+    else:
+        selected = [("%s.lap%d" % (name, lap['lap']), lap)
+            for lap in session.get('laps', [])]
+
+    written = []
+    for (lap_name, lap) in selected:
+        (start, end) = get_lap_range(session, video_details, lap)
+        if start >= end:
+            continue
+        path = lap_name + ".mlt"
+        with profiling.stage("mlt_generation"):
+            xml = make_mlt(session, video_details, layout, [(start, end)])
+            open(path, "w").write(xml)
+        written.append((lap_name, path, end - start))
+
+    return written
+
+def get_render_key(mlt_path, session, consumer_args):
+    """Return a hash identifying everything that goes into rendering
+    mlt_path: the MLT itself, the videos it uses and the output settings. If
+    this hasn't changed since the last render, neither has the output."""
+    key = hashlib.sha1(open(mlt_path).read())
+    for view in session['views'].values():
+        for path in view['paths']:
+            st = os.stat(path)
+            key.update("%s:%d:%f" % (path, st.st_size, st.st_mtime))
+    key.update(" ".join(renderqueue.CONSUMER_ARGS + list(consumer_args)))
+    return key.hexdigest()
+
+def get_chunk_ranges(start, end, chunks, gop):
+    """Split the frames from start to end into up to chunks (start, end)
+    ranges, each a multiple of gop frames long so that every chunk starts a
+    new GOP."""
+    size = max(gop, int(math.ceil((end - start) / float(chunks) / gop)) * gop)
+    return [(first, min(first + size, end)) for first in range(start, end, size)]
+
+def write_chunked_session_mlt(session, name, layout, chunks, gop, start=0,
+        length=None, probe_cache=None):
+    """Write name.chunkK.mlt for each of up to chunks time ranges of
+    session, so that they can be rendered in parallel. Returns a list of
+    (mlt path, output path, frames) tuples for the chunks in order."""
+    video_details = get_session_video_details(session, probe_cache)
+    (start, end) = get_window(session, video_details, start, length)
+    if end <= start:
+        return []
+
+    written = []
+    for (chunk, (first, last)) in enumerate(get_chunk_ranges(start, end, chunks, gop)):
+        path = "%s.chunk%d.mlt" % (name, chunk)
+        with profiling.stage("mlt_generation"):
+            xml = make_mlt(session, video_details, layout, [(first, last)])
+            open(path, "w").write(xml)
+        written.append((path, "%s.chunk%d.mp4" % (name, chunk), last - first))
+
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", action="store", default="sessions.yaml")
+    parser.add_argument("--index", action="append", type=int, default=[],
+        help="Session index to render, may be given more than once.")
+    parser.add_argument("--all", action="store_true", default=False,
+        help="Render every session.")
+    parser.add_argument("--start", action="store", type=int, default=0,
+        help="Frame of the session to start rendering from.")
+    parser.add_argument("--length", action="store", type=int, default=None,
+        help="Number of frames to render.")
+    parser.add_argument("--draft", action="store_true", default=False,
+        help="Render quickly at low quality from the low resolution proxies.")
+    parser.add_argument("--layout", action="store", default="front:inside:back")
+    parser.add_argument("--probe-cache", action="store", default="probe-cache.sqlite")
+    parser.add_argument("--queue", action="store_true", default=False,
+        help="Run melt to render the generated MLT files.")
+    parser.add_argument("--queue-state", action="store", default="render-queue.json")
+    parser.add_argument("--jobs", action="store", type=int, default=None,
+        help="Number of melt jobs to run at once, defaults to what the "
+        "available CPU cores and memory allow.")
+    parser.add_argument("--highlights", action="store_true", default=False,
+        help="Only render the parts of each session around HiLight tags.")
+    parser.add_argument("--pre-roll", action="store", type=float, default=10,
+        help="Seconds to include before each HiLight tag.")
+    parser.add_argument("--post-roll", action="store", type=float, default=5,
+        help="Seconds to include after each HiLight tag.")
+    parser.add_argument("--laps", action="store_true", default=False,
+        help="Render each lap of each session separately, using the laps "
+        "found by assemble.py --log.")
+    parser.add_argument("--best-lap", action="store_true", default=False,
+        help="Only render the fastest lap of each session.")
+    parser.add_argument("--chunks", action="store", type=int, default=None,
+        help="Split each session into this many chunks which are rendered "
+        "in parallel and then joined. Implies --queue.")
+    parser.add_argument("--gop", action="store", type=int, default=120,
+        help="Keyframe interval in frames when rendering chunks.")
+    parser.add_argument("--threads-per-job", action="store", type=int,
+        default=renderqueue.THREADS_PER_JOB)
+    parser.add_argument("--memory-per-job", action="store", type=int,
+        default=renderqueue.MEMORY_PER_JOB, help="In MB.")
+    parser.add_argument("--profile", action="store", default=None,
+        help="Write timing statistics to this file as JSON.")
+    parser.add_argument("--cprofile", action="store", default=None,
+        help="Write cProfile stats to this file.")
+    args = parser.parse_args()
+
+    if not args.index and not args.all:
+        parser.error("Either --index or --all is required.")
+    if args.highlights and (args.chunks or args.start or args.length):
+        parser.error("--highlights can't be used with --chunks, --start or --length.")
+    if (args.laps or args.best_lap) and (args.highlights or args.chunks or
+            args.start or args.length):
+        parser.error("--laps and --best-lap can't be used with --highlights, "
+            "--chunks, --start or --length.")
+
+    if args.profile:
+        profiling.enable()
+    if args.cprofile:
+        profiler = profiling.start_cprofile()
+
+    if mlt is not None:
+        mlt.Factory.init()
+    probe_cache = metacache.MetadataCache(args.probe_cache)
+
+    indexes = args.index
+    try:
+        with profiling.stage("session_load"):
+            sessions = sessionstore.open_sessions(args.path)
+            if args.all:
+                indexes = range(len(sessions))
+            selected = [(index, sessions[index]) for index in indexes]
+    except Exception, ex:
+        print >> sys.stderr, "Failed to load sessions %r from %s: %r" % (indexes, args.path, ex)
+        raise SystemExit(1)
+
+    layout = args.layout.split(":")
+
+    queue = None
+    if args.queue or args.chunks:
+        queue = renderqueue.RenderQueue(args.queue_state)
+
+    # Outputs of the chunks of each chunked session, in order.
+    chunked = {}
+
+    consumer_args = []
+    if args.draft:
+        consumer_args = renderqueue.DRAFT_CONSUMER_ARGS
+
+    for (index, session) in selected:
+        name = "session-%d" % index
+        if args.draft:
+            # Same layout and offsets, but from the proxies.
+            session = proxies.use_proxies(session)
+            name += ".draft"
+
+        if args.highlights:
+            name += ".highlights"
+
+        pprint.pprint(session)
+        if args.highlights:
+            written = write_highlights_mlt(session, name, layout,
+                args.pre_roll, args.post_roll, probe_cache)
+            if written is None:
+                print "%s: no highlights." % name
+                continue
+            (mlt_path, frames) = written
+            if queue is not None:
+                queue.add(name, mlt_path, name + ".mp4", frames, consumer_args,
+                    get_render_key(mlt_path, session, consumer_args))
+        elif args.laps or args.best_lap:
+            written = write_laps_mlt(session, name, layout, args.best_lap,
+                probe_cache)
+            if not written:
+                print "%s: no laps." % name
+            for (lap_name, mlt_path, frames) in written:
+                if queue is not None:
+                    queue.add(lap_name, mlt_path, lap_name + ".mp4", frames,
+                        consumer_args, get_render_key(mlt_path, session,
+                        consumer_args))
+        elif args.chunks:
+            chunks = write_chunked_session_mlt(session, name, layout,
+                args.chunks, args.gop, args.start, args.length, probe_cache)
+            if not chunks:
+                # Joining no chunks would fail, so don't queue any.
+                print >> sys.stderr, "%s: nothing to render from frame %d." % (
+                    name, args.start)
+                continue
+
+            # Force a fixed GOP size so that the chunks, which each start on a
+            # GOP boundary, join up as a consistent stream.
+            chunk_args = consumer_args + ["g=%d" % args.gop,
+                "keyint_min=%d" % args.gop, "sc_threshold=0"]
+            chunk_keys = [get_render_key(mlt_path, session, chunk_args)
+                for (mlt_path, output, frames) in chunks]
+
+            # The chunks are deleted once they're joined, so check whether
+            # the joined output is already up to date.
+            joined_key = hashlib.sha1(" ".join(chunk_keys)).hexdigest()
+            if queue.is_current(name, joined_key):
+                print "%s: up to date." % name
+                continue
+
+            chunked[name] = (joined_key, [])
+            for (chunk, (mlt_path, output, frames)) in enumerate(chunks):
+                chunk_name = "%s.chunk%d" % (name, chunk)
+                queue.add(chunk_name, mlt_path, output, frames, chunk_args,
+                    chunk_keys[chunk])
+                chunked[name][1].append((chunk_name, output))
+        else:
+            (mlt_path, frames) = write_session_mlt(session, name, layout,
+                args.start, args.length, probe_cache)
+            if queue is not None:
+                queue.add(name, mlt_path, name + ".mp4", frames, consumer_args,
+                    get_render_key(mlt_path, session, consumer_args))
+    probe_cache.save()
+
+    if queue is not None:
+        jobs = args.jobs
+        if jobs is None:
+            jobs = renderqueue.get_worker_count(args.threads_per_job,
+                args.memory_per_job)
+        queue.run(jobs, args.threads_per_job)
+
+    for (name, (joined_key, chunks)) in sorted(chunked.items()):
+        if not all(queue.is_done(chunk_name) for (chunk_name, output) in chunks):
+            print >> sys.stderr, "Not joining %s, some chunks failed." % name
+            continue
 
-open("session-%d.mlt" % args.index, "w").write(xml)
+        outputs = [output for (chunk_name, output) in chunks]
+        if renderqueue.concatenate(outputs, name + ".mp4"):
+            queue.mark_done(name, name + ".mp4", joined_key)
+            for output in outputs:
+                os.remove(output)
+        else:
+            print >> sys.stderr, "Failed to join the chunks of %s." % name
 
+    if args.cprofile:
+        profiling.stop_cprofile(profiler, args.cprofile)
+    if args.profile:
+        profiling.write_report(args.profile)
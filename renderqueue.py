@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Run melt over a batch of sessions, a few at a time.
+
+The state of each job is saved to a JSON file as the queue runs, so an
+interrupted batch picks up where it stopped when it's run again.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+import multiprocessing
+
+# Encoder threads given to each melt job.
+THREADS_PER_JOB = 2
+
+# Rough memory use of a melt job compositing several 1080p streams, in MB.
+MEMORY_PER_JOB = 1500
+
+# Seconds between checks on running jobs.
+POLL_INTERVAL = 1.0
+
+CONSUMER_ARGS = ["acodec=aac", "vcodec=libx264"]
+
+# Added to CONSUMER_ARGS for draft renders, which only need to be good enough
+# to check sync and layout.
+DRAFT_CONSUMER_ARGS = ["width=640", "height=360", "preset=ultrafast",
+    "crf=32", "ab=64k"]
+
+def get_available_memory():
+    """Return the available memory in MB, or None if it can't be found."""
+    try:
+        for line in open("/proc/meminfo"):
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return None
+
+def get_worker_count(threads_per_job=THREADS_PER_JOB, memory_per_job=MEMORY_PER_JOB):
+    """Return how many melt jobs can be run at once without oversubscribing
+    the CPU cores or running out of memory."""
+    workers = max(1, multiprocessing.cpu_count() // threads_per_job)
+
+    memory = get_available_memory()
+    if memory is not None:
+        workers = min(workers, max(1, memory // memory_per_job))
+
+    return workers
+
+def get_partial_path(path):
+    (base, ext) = os.path.splitext(path)
+    return base + ".partial" + ext
+
+def concatenate(paths, output):
+    """Join the videos at paths into output without re-encoding them, using
+    ffmpeg's concat demuxer. Returns True if it succeeded."""
+    list_path = output + ".txt"
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write("file '%s'\n" % os.path.abspath(path).replace("'", "'\\''"))
+
+    try:
+        returncode = subprocess.call(["ffmpeg", "-v", "error", "-y", "-nostdin",
+            "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output])
+    finally:
+        os.remove(list_path)
+
+    return returncode == 0
+
+class RenderJob(object):
+    """A single running melt process."""
+
+    def __init__(self, state, threads):
+        self.state = state
+        self.frame = 0
+        self.started = time.time()
+
+        command = ["melt", "-progress", "xml:" + state['mlt'],
+            "-consumer", "avformat:" + get_partial_path(state['output'])]
+        command += CONSUMER_ARGS + state.get('consumer_args', [])
+        command += ["threads=%d" % threads]
+
+        self.process = subprocess.Popen(command, stderr=subprocess.PIPE)
+        self.reader = threading.Thread(target=self.read_progress)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_progress(self):
+        # melt reports progress on stderr, rewriting the same line with
+        # carriage returns.
+        buf = ""
+        while True:
+            chunk = os.read(self.process.stderr.fileno(), 256)
+            if not chunk:
+                break
+            buf += chunk
+            lines = re.split("[\r\n]", buf)
+            buf = lines.pop()
+            for line in lines:
+                match = re.search(r"Current Frame:\s*(\d+)", line)
+                if match:
+                    self.frame = int(match.group(1))
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def fps(self):
+        elapsed = self.elapsed()
+        if elapsed == 0:
+            return 0.0
+        return self.frame / elapsed
+
+    def progress(self):
+        return "%s: %d/%d frames, %.1f fps" % (self.state['name'],
+            self.frame, self.state['frames'], self.fps())
+
+class RenderQueue(object):
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.jobs = json.load(open(path))['jobs']
+        except (IOError, ValueError, KeyError):
+            self.jobs = {}
+
+        # Only jobs added during this run are rendered, leaving any others
+        # in the state file alone.
+        self.selected = set()
+
+    def save(self):
+        # Write to a temporary file first so the state is never left half
+        # written if we're interrupted.
+        tmp = self.path + ".tmp"
+        open(tmp, "w").write(json.dumps({"jobs": self.jobs}, indent=2, sort_keys=True))
+        os.rename(tmp, self.path)
+
+    def is_current(self, name, key):
+        """Return True if name has already been rendered from inputs matching
+        key, and the output is still there."""
+        job = self.jobs.get(name)
+        return job is not None and job['status'] == "done" and \
+            job.get('key') == key and os.path.exists(job['output'])
+
+    def add(self, name, mlt_path, output, frames, consumer_args=(), key=None):
+        """Queue rendering mlt_path to output, unless it was already rendered
+        from the same inputs, identified by key. Returns True if the job was
+        queued."""
+        self.selected.add(name)
+        if key is not None and self.is_current(name, key):
+            print "%s: up to date." % name
+            return False
+
+        self.jobs[name] = {
+            "name": name,
+            "mlt": mlt_path,
+            "output": output,
+            "frames": frames,
+            "consumer_args": list(consumer_args),
+            "key": key,
+            "status": "pending",
+        }
+        self.save()
+        return True
+
+    def mark_done(self, name, output, key):
+        """Record that output was produced from inputs matching key, other
+        than by running a job, such as by joining chunks."""
+        self.jobs[name] = {
+            "name": name,
+            "output": output,
+            "key": key,
+            "status": "done",
+        }
+        self.save()
+
+    def pending(self):
+        jobs = [job for (key, job) in self.jobs.items()
+            if key in self.selected and job['status'] != "done"]
+        # Sort numbers within names numerically, so session-10 comes after
+        # session-9.
+        jobs.sort(key=lambda job: [int(part) if part.isdigit() else part
+            for part in re.split(r"(\d+)", job['name'])])
+        return jobs
+
+    def is_done(self, name):
+        return self.jobs[name]['status'] == "done"
+
+    def finish(self, job):
+        returncode = job.process.wait()
+        job.reader.join()
+
+        state = job.state
+        state['elapsed'] = job.elapsed()
+        if returncode == 0:
+            os.rename(get_partial_path(state['output']), state['output'])
+            state['status'] = "done"
+            state['fps'] = state['frames'] / max(state['elapsed'], 0.001)
+            print "%s: done in %.0fs, %.1f fps" % (state['name'],
+                state['elapsed'], state['fps'])
+        else:
+            state['status'] = "failed"
+            print >> sys.stderr, "%s: melt failed with exit code %d" % (
+                state['name'], returncode)
+        self.save()
+
+    def run(self, workers, threads=THREADS_PER_JOB):
+        """Render every job that isn't done yet, running up to workers melt
+        processes at once."""
+        pending = self.pending()
+        running = []
+        print "Rendering %d jobs, %d at a time." % (len(pending), workers)
+
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    state = pending.pop(0)
+                    state['status'] = "running"
+                    try:
+                        running.append(RenderJob(state, threads))
+                    except OSError as ex:
+                        # Most likely melt isn't installed.
+                        state['status'] = "failed"
+                        print >> sys.stderr, "%s: couldn't run melt: %s" % (
+                            state['name'], ex)
+                    self.save()
+
+                time.sleep(POLL_INTERVAL)
+
+                for job in [job for job in running if job.process.poll() is not None]:
+                    running.remove(job)
+                    self.finish(job)
+
+                if running:
+                    print "; ".join(job.progress() for job in running)
+        except KeyboardInterrupt:
+            # Leave interrupted jobs to be started again on the next run.
+            for job in running:
+                job.process.terminate()
+                job.process.wait()
+                job.state['status'] = "pending"
+            self.save()
+            raise
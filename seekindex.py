@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Frame and keyframe indexes of videos, for quick and exact seeking.
+
+Seeking to an arbitrary time in a long-GOP video means decoding from the
+keyframe before it, so seeking straight to a keyframe is much quicker. The
+times of every frame and keyframe are read from the MP4 sample tables and
+kept in a cache directory, so they only need to be read once per file.
+"""
+
+import os
+import hashlib
+
+import numpy
+
+import mp4box
+import profiling
+
+INDEX_DIR = "seek-index"
+
+# Bump this whenever the structure of the cached indexes changes.
+INDEX_VERSION = 1
+
+class SeekIndex(object):
+    def __init__(self, times, keyframes, timescale):
+        # The start of each frame in the track's timescale, followed by the
+        # end of the last frame.
+        self.times = times
+        # The numbers of the keyframes, counting from 0.
+        self.keyframes = keyframes
+        self.timescale = timescale
+
+        self.times_ms = times * 1000.0 / timescale
+        self.keyframe_times_ms = self.times_ms[keyframes]
+
+    def __len__(self):
+        return len(self.times) - 1
+
+    def duration(self):
+        """Return the length of the video in milliseconds."""
+        return self.times_ms[-1]
+
+    def time_of(self, frame):
+        """Return the time in milliseconds that frame starts at."""
+        return self.times_ms[frame]
+
+    def frame_at(self, ms):
+        """Return the number of the frame being shown at ms."""
+        frame = numpy.searchsorted(self.times_ms, ms, side="right") - 1
+        return int(min(max(frame, 0), len(self) - 1))
+
+    def nearest_keyframe(self, ms):
+        """Return (frame, time) of the keyframe closest to ms, with the time
+        in milliseconds."""
+        if len(self.keyframes) == 0:
+            # Only an empty video has no keyframes at all.
+            return (0, 0.0)
+        i = numpy.searchsorted(self.keyframe_times_ms, ms)
+        if i == len(self.keyframes) or (i > 0 and
+                ms - self.keyframe_times_ms[i - 1] < self.keyframe_times_ms[i] - ms):
+            i -= 1
+        return (int(self.keyframes[i]), self.keyframe_times_ms[i])
+
+def build_seek_index(path):
+    """Read the seek index of the video at path from its sample tables, or
+    return None if they can't be parsed."""
+    tables = mp4box.read_sample_tables(path)
+    if tables is None or len(tables['stts']) == 0:
+        return None
+
+    (counts, deltas) = zip(*tables['stts'])
+    times = numpy.concatenate([[0], numpy.cumsum(numpy.repeat(
+        numpy.asarray(deltas, dtype=numpy.int64), counts))])
+
+    if not tables['stss']:
+        # A missing stss box means every frame is a keyframe. An empty one
+        # shouldn't happen, so treat it the same rather than having none.
+        keyframes = numpy.arange(len(times) - 1)
+    else:
+        keyframes = numpy.asarray(tables['stss'], dtype=numpy.int64) - 1
+
+    return SeekIndex(times, keyframes, tables['timescale'])
+
+def get_cache_path(path, index_dir=INDEX_DIR):
+    """Return where the seek index for the file at path is cached. The name
+    changes whenever the file does, so stale indexes are never used."""
+    st = os.stat(path)
+    key = "%d:%s:%d:%r" % (INDEX_VERSION, os.path.abspath(path), st.st_size,
+        st.st_mtime)
+    return os.path.join(index_dir, hashlib.sha1(key).hexdigest() + ".npz")
+
+def get_seek_index(path, index_dir=INDEX_DIR):
+    """Return the SeekIndex for the video at path, loading it from index_dir
+    if it has been built before. Returns None if the file can't be
+    indexed."""
+    cache_path = get_cache_path(path, index_dir)
+    try:
+        with profiling.stage("seek_index_load"):
+            data = numpy.load(cache_path)
+            return SeekIndex(data['times'], data['keyframes'], int(data['timescale']))
+    except (IOError, KeyError):
+        pass
+
+    with profiling.stage("seek_index_build"):
+        index = build_seek_index(path)
+    if index is None:
+        return None
+
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    # Write to a temporary file first so a half written index is never
+    # loaded.
+    tmp = cache_path + ".tmp"
+    with open(tmp, "wb") as f:
+        numpy.savez(f, times=index.times, keyframes=index.keyframes,
+            timescale=index.timescale)
+    os.rename(tmp, cache_path)
+    return index
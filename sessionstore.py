@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Indexed storage of sessions.
+
+sessions.yaml is convenient to read and edit, but has to be parsed in full to
+get at any one session. The sessions are also kept in a SQLite database next
+to it, one row per session, so tools can load a single session directly. The
+database is rebuilt from the YAML whenever the YAML changes.
+"""
+
+import os
+import json
+import sqlite3
+
+import yaml
+
+class SessionStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            idx INTEGER PRIMARY KEY,
+            data TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT)""")
+        self.db.commit()
+
+    def __len__(self):
+        (count,) = self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()
+        return count
+
+    def __getitem__(self, index):
+        row = self.db.execute("SELECT data FROM sessions WHERE idx = ?",
+            (index,)).fetchone()
+        if row is None:
+            raise IndexError("No session with index %d" % index)
+        return json.loads(row[0])
+
+    def replace(self, sessions):
+        """Replace everything in the store with the list sessions."""
+        self.db.execute("DELETE FROM sessions")
+        self.db.executemany("INSERT INTO sessions (idx, data) VALUES (?, ?)",
+            [(index, json.dumps(session)) for (index, session) in enumerate(sessions)])
+        self.db.commit()
+
+    def update(self, index, session):
+        """Replace the single session at index."""
+        self.db.execute("INSERT OR REPLACE INTO sessions (idx, data) VALUES (?, ?)",
+            (index, json.dumps(session)))
+        self.db.commit()
+
+    def truncate(self, count):
+        """Remove every session from index count onwards."""
+        self.db.execute("DELETE FROM sessions WHERE idx >= ?", (count,))
+        self.db.commit()
+
+    def export(self):
+        """Return a list of all the sessions in the store."""
+        return [json.loads(data) for (data,) in
+            self.db.execute("SELECT data FROM sessions ORDER BY idx")]
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value))
+        self.db.commit()
+
+def get_store_path(yaml_path):
+    return os.path.splitext(yaml_path)[0] + ".sqlite"
+
+def get_yaml_version(yaml_path):
+    st = os.stat(yaml_path)
+    return "%d:%r" % (st.st_size, st.st_mtime)
+
+def open_sessions(yaml_path):
+    """Return the SessionStore for the sessions in yaml_path, importing them
+    first if the YAML has changed since it was last imported."""
+    store = SessionStore(get_store_path(yaml_path))
+    if os.path.exists(yaml_path):
+        version = get_yaml_version(yaml_path)
+        if store.get_meta("yaml_version") != version:
+            store.replace(yaml.load(open(yaml_path).read()))
+            store.set_meta("yaml_version", version)
+    return store
+
+def save_sessions(sessions, yaml_path):
+    """Write sessions to yaml_path and to the store alongside it."""
+    open(yaml_path, "w").write(yaml.safe_dump(sessions))
+    store = SessionStore(get_store_path(yaml_path))
+    store.replace(sessions)
+    store.set_meta("yaml_version", get_yaml_version(yaml_path))
+    return store
+
+def update_sessions(sessions, changed, yaml_path):
+    """Write sessions to yaml_path, but only update the sessions at the
+    indexes in changed in the store alongside it."""
+    open(yaml_path, "w").write(yaml.safe_dump(sessions))
+    store = SessionStore(get_store_path(yaml_path))
+    for index in changed:
+        store.update(index, sessions[index])
+    store.truncate(len(sessions))
+    store.set_meta("yaml_version", get_yaml_version(yaml_path))
+    return store
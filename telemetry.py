@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""Engine telemetry from OBD, CAN bus and data logger CSV exports.
+
+Each log is imported once into a directory holding a .npy file per channel,
+streaming the CSV so the whole log is never held in memory. The channels are
+memory-mapped when queried, and only the rows covering the time range asked
+for are read, so pulling a session's worth of data out of a day long log
+costs little more than the session itself.
+"""
+
+import os
+import re
+import sys
+import csv
+import json
+import array
+import shutil
+import hashlib
+import argparse
+
+import numpy
+
+import gpslog
+import metacache
+import profiling
+import sessionstore
+
+TELEMETRY_DIR = "telemetry"
+
+# Bump this whenever the layout of the imported logs changes.
+STORE_VERSION = 1
+
+# Rows of each channel held in memory while importing before they're written
+# out.
+FLUSH_ROWS = 65536
+
+# Times smaller than this are seconds since logging started rather than
+# since the Unix epoch.
+RELATIVE_TIME_LIMIT = 1e8
+
+# Frames further than this many seconds from a sample, such as when the
+# logger was switched off, are left empty rather than interpolated.
+MAX_GAP = 2.0
+
+def get_store_path(path, telemetry_dir=TELEMETRY_DIR):
+    """Return the directory the log at path is imported into. Loggers tend
+    to reuse file names, so the name includes a hash of the full path."""
+    (base, ext) = os.path.splitext(os.path.basename(path))
+    key = hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+    return os.path.join(telemetry_dir, "%s-%s" % (base, key))
+
+def get_channel_file(name, used):
+    """Return a file name for the channel called name which isn't in
+    used, and add it to used."""
+    base = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_") or "channel"
+    filename = base + ".npy"
+    suffix = 1
+    while filename in used or filename == "times.npy":
+        suffix += 1
+        filename = "%s_%d.npy" % (base, suffix)
+    used.add(filename)
+    return filename
+
+class TelemetryLog(object):
+    """An imported log. times are seconds since the Unix epoch in UTC, and
+    each channel has a value per time, or NaN where it wasn't logged."""
+
+    def __init__(self, store_path):
+        self.path = store_path
+        self.info = json.load(open(os.path.join(store_path, "store.json")))
+        self.times = numpy.load(os.path.join(store_path, "times.npy"),
+            mmap_mode="r")
+        self.files = dict((channel['name'], channel['file'])
+            for channel in self.info['channels'])
+        self._channels = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def channels(self):
+        return [channel['name'] for channel in self.info['channels']]
+
+    def channel(self, name):
+        """Return the memory-mapped values of the channel called name."""
+        if name not in self._channels:
+            self._channels[name] = numpy.load(os.path.join(self.path,
+                self.files[name]), mmap_mode="r")
+        return self._channels[name]
+
+    def start_time(self):
+        return float(self.times[0])
+
+    def end_time(self):
+        return float(self.times[-1])
+
+    def get_range(self, start_time, end_time):
+        """Return (start, end) indexes of the rows from start_time up to
+        end_time."""
+        return (int(numpy.searchsorted(self.times, start_time, side="left")),
+            int(numpy.searchsorted(self.times, end_time, side="right")))
+
+    def get_slice(self, name, start_time, end_time):
+        """Return (times, values) of the channel called name from start_time
+        to end_time."""
+        (start, end) = self.get_range(start_time, end_time)
+        return (self.times[start:end], self.channel(name)[start:end])
+
+    def resample(self, names, start_time, fps, frames, max_gap=MAX_GAP):
+        """Return a dict of each channel in names to an array of its value at
+        each of frames frames at fps, from start_time, interpolated between
+        the samples either side of each frame. Frames outside the log or in a
+        gap of more than max_gap seconds are NaN."""
+        frame_times = start_time + numpy.arange(frames) / float(fps)
+        resampled = dict((name, numpy.empty(frames)) for name in names)
+        for values in resampled.values():
+            values.fill(numpy.nan)
+        if frames == 0 or len(self) == 0:
+            return resampled
+
+        # Include the samples either side of the range so the first and last
+        # frames can be interpolated.
+        (start, end) = self.get_range(frame_times[0], frame_times[-1])
+        start = max(0, start - 1)
+        end = min(len(self), end + 1)
+        times = numpy.asarray(self.times[start:end])
+
+        for name in names:
+            values = numpy.asarray(self.channel(name)[start:end])
+            logged = ~numpy.isnan(values)
+            if not logged.any():
+                continue
+            (channel_times, values) = (times[logged], values[logged])
+
+            interpolated = numpy.interp(frame_times, channel_times, values,
+                left=numpy.nan, right=numpy.nan)
+            if len(channel_times) > 1:
+                # The samples either side of each frame.
+                after = numpy.clip(numpy.searchsorted(channel_times, frame_times),
+                    1, len(channel_times) - 1)
+                gaps = channel_times[after] - channel_times[after - 1]
+                # A frame right on a sample at the edge of a gap has a value.
+                on_sample = (channel_times[after] == frame_times) | \
+                    (channel_times[after - 1] == frame_times)
+                interpolated[(gaps > max_gap) & ~on_sample] = numpy.nan
+            resampled[name] = interpolated
+
+        return resampled
+
+class _ChannelWriter(object):
+    """Streams the values of a channel to a file of raw doubles, which is
+    turned into a .npy file once the number of rows is known."""
+
+    def __init__(self, path):
+        self.path = path
+        self.raw = open(path + ".raw", "wb")
+        self.buffer = array.array("d")
+        self.rows = 0
+        self.logged = False
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.raw)
+        self.rows += len(self.buffer)
+        self.buffer = array.array("d")
+
+    def close(self):
+        self.flush()
+        self.raw.close()
+
+        out = numpy.lib.format.open_memmap(self.path, mode="w+",
+            dtype=numpy.float64, shape=(self.rows,))
+        if self.rows:
+            raw = numpy.memmap(self.path + ".raw", dtype=numpy.float64,
+                mode="r", shape=(self.rows,))
+            for start in range(0, self.rows, FLUSH_ROWS):
+                out[start:start + FLUSH_ROWS] = raw[start:start + FLUSH_ROWS]
+            del raw
+        out.flush()
+        del out
+        os.remove(self.path + ".raw")
+
+def _sort_store(store_path, files):
+    """Sort every channel of the store at store_path by time, for logs
+    which weren't written in order. Only one channel is in memory at once."""
+    times = numpy.load(os.path.join(store_path, "times.npy"), mmap_mode="r+")
+    order = numpy.argsort(times, kind="mergesort")
+    for filename in ["times.npy"] + files:
+        values = numpy.load(os.path.join(store_path, filename), mmap_mode="r+")
+        values[:] = values[order]
+        values.flush()
+        del values
+
+def import_csv(path, store_path, start_time=None):
+    """Import the CSV log at path into store_path. Every numeric column
+    other than the time becomes a channel. Times may be since logging
+    started, in which case start_time, the UTC time logging started, is
+    required."""
+    with open(path) as f:
+        reader = csv.reader(f)
+        # Skip any preamble before the header.
+        header = None
+        for row in reader:
+            names = [column.strip() for column in row]
+            time_index = gpslog.find_column([name.lower() for name in names],
+                gpslog.CSV_COLUMNS['time'])
+            if time_index is not None:
+                header = names
+                break
+        if header is None:
+            raise ValueError("%s doesn't have a header naming a time column" % path)
+
+        partial_path = store_path + ".partial"
+        if os.path.isdir(partial_path):
+            shutil.rmtree(partial_path)
+        os.makedirs(partial_path)
+
+        used = set()
+        columns = [(index, name, get_channel_file(name, used))
+            for (index, name) in enumerate(header) if index != time_index and name]
+        times = _ChannelWriter(os.path.join(partial_path, "times.npy"))
+        writers = [_ChannelWriter(os.path.join(partial_path, filename))
+            for (index, name, filename) in columns]
+
+        offset = None
+        in_order = True
+        last_time = None
+        nan = float("nan")
+        for row in reader:
+            try:
+                time = gpslog.parse_time(row[time_index])
+            except (ValueError, IndexError):
+                # Blank or corrupt line, or a units row below the header.
+                continue
+
+            if offset is None:
+                offset = 0.0
+                if time < RELATIVE_TIME_LIMIT:
+                    if start_time is None:
+                        raise ValueError("%s has times relative to the start "
+                            "of logging, so its start time is needed" % path)
+                    offset = start_time
+            time += offset
+            if last_time is not None and time < last_time:
+                in_order = False
+            last_time = time
+
+            times.append(time)
+            for ((index, name, filename), writer) in zip(columns, writers):
+                try:
+                    writer.append(float(row[index]))
+                    writer.logged = True
+                except (ValueError, IndexError):
+                    writer.append(nan)
+
+    times.close()
+    channels = []
+    for ((index, name, filename), writer) in zip(columns, writers):
+        writer.close()
+        # Columns without any numbers, such as notes, aren't channels.
+        if writer.logged:
+            channels.append({"name": name, "file": filename})
+        else:
+            os.remove(os.path.join(partial_path, filename))
+
+    if times.rows == 0:
+        shutil.rmtree(partial_path)
+        raise ValueError("%s doesn't have any rows with a time that can be "
+            "read" % path)
+
+    if not in_order:
+        _sort_store(partial_path, [channel['file'] for channel in channels])
+
+    st = os.stat(path)
+    info = {
+        "version": STORE_VERSION,
+        "source": os.path.abspath(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "start_time": start_time,
+        "rows": times.rows,
+        "channels": channels,
+    }
+    json.dump(info, open(os.path.join(partial_path, "store.json"), "w"))
+
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.rename(partial_path, store_path)
+
+def is_current(path, store_path, start_time=None):
+    """Return True if the log at path has been imported into store_path
+    since it was last changed."""
+    try:
+        info = json.load(open(os.path.join(store_path, "store.json")))
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return False
+    return (info['version'], info['source'], info['size'], info['mtime'],
+        info['start_time']) == (STORE_VERSION, os.path.abspath(path),
+        st.st_size, st.st_mtime, start_time)
+
+def open_log(path, telemetry_dir=TELEMETRY_DIR, start_time=None):
+    """Return the TelemetryLog of the CSV log at path, importing it first if
+    it hasn't been imported or has changed since."""
+    store_path = get_store_path(path, telemetry_dir)
+    if not is_current(path, store_path, start_time):
+        with profiling.stage("telemetry_import"):
+            import_csv(path, store_path, start_time)
+    return TelemetryLog(store_path)
+
+def attach_telemetry(sessions, logs, clock_offset=0.0):
+    """Record each of logs which overlaps with each of sessions in the
+    session's telemetry, with the UTC times the session starts and ends.
+    clock_offset is how many seconds the cameras' clocks are ahead of UTC.
+    Returns the number of sessions with telemetry."""
+    matched = 0
+    for session in sessions:
+        if 'start_time' not in session or 'duration' not in session:
+            continue
+        start = session['start_time'] - clock_offset
+        end = start + session['duration']
+
+        found = []
+        for log in logs:
+            if len(log) and log.start_time() < end and log.end_time() > start:
+                found.append({
+                    "path": log.path,
+                    "start_time": float(start),
+                    "end_time": float(end),
+                })
+        if found:
+            session['telemetry'] = found
+            matched += 1
+        else:
+            session.pop('telemetry', None)
+
+    return matched
+
+def get_view_start_time(session, entry, camera=None):
+    """Return the UTC time of the first frame of camera's view of session,
+    going by entry from the session's telemetry, or of the start of the
+    session's timeline if camera is None."""
+    start = entry['start_time']
+    if camera is not None:
+        # A view's offset is how far into its recording the session starts.
+        start -= session['views'][camera].get('offset', 0) / 1000.0
+    return start
+
+def resample_session(session, names, fps, frames, camera=None):
+    """Return a dict of each channel in names to its value at each of frames
+    frames at fps, either of the session's timeline or of camera's view,
+    from whichever of the session's telemetry logs has the channel."""
+    resampled = {}
+    for entry in session.get('telemetry', []):
+        log = TelemetryLog(entry['path'])
+        wanted = [name for name in names
+            if name in log.files and name not in resampled]
+        resampled.update(log.resample(wanted,
+            get_view_start_time(session, entry, camera), fps, frames))
+    return resampled
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the telemetry of a session as a CSV with a row per "
+        "video frame.")
+    parser.add_argument("--path", action="store", default="sessions.yaml")
+    parser.add_argument("--index", action="store", type=int, required=True)
+    parser.add_argument("--channel", action="append", default=[],
+        help="Channel to include, may be given more than once. Defaults to "
+        "every channel.")
+    parser.add_argument("--camera", action="store", default=None,
+        help="Line up the rows with this camera's videos rather than the "
+        "session's timeline.")
+    parser.add_argument("--probe-cache", action="store", default="probe-cache.sqlite")
+    parser.add_argument("--output", action="store", default=None,
+        help="Defaults to stdout.")
+    args = parser.parse_args()
+
+    # render.py needs jinja2, so only import it when it's used.
+    import render
+
+    session = sessionstore.open_sessions(args.path)[args.index]
+    if not session.get('telemetry'):
+        print >> sys.stderr, "Session %d has no telemetry." % args.index
+        raise SystemExit(1)
+
+    names = args.channel
+    if not names:
+        for entry in session['telemetry']:
+            names.extend(name for name in TelemetryLog(entry['path']).channels()
+                if name not in names)
+
+    probe_cache = metacache.MetadataCache(args.probe_cache)
+    video_details = render.get_session_video_details(session, probe_cache)
+    probe_cache.save()
+    if args.camera is None:
+        view = session['views'].values()[0]
+        frames = render.get_session_frames(session, video_details)
+    else:
+        view = session['views'][args.camera]
+        frames = sum(video_details[path]['frames'] for path in view['paths'])
+    fps = video_details[view['paths'][0]]['fps']
+
+    resampled = resample_session(session, names, fps, frames, args.camera)
+    names = [name for name in names if name in resampled]
+
+    out = sys.stdout if args.output is None else open(args.output, "w")
+    writer = csv.writer(out)
+    writer.writerow(["frame"] + names)
+    for frame in range(frames):
+        writer.writerow([frame] + ["" if numpy.isnan(resampled[name][frame])
+            else "%g" % resampled[name][frame] for name in names])
@@ -0,0 +1,21 @@
+import numpy
+
+import audiosync
+
+def test_correlate_offset_sign():
+    numpy.random.seed(1)
+    envelope = numpy.random.rand(2000)
+    # Everything in envelope is heard half a second later in other.
+    lag = audiosync.ENVELOPE_RATE // 2
+    other = numpy.concatenate([numpy.random.rand(lag), envelope])[:2000]
+
+    (offset, confidence) = audiosync.correlate(envelope, other)
+    assert offset == 500
+    assert confidence > 0.9
+
+    (offset, confidence) = audiosync.correlate(other, envelope)
+    assert offset == -500
+
+def test_correlate_flat_or_missing():
+    assert audiosync.correlate(None, numpy.ones(10)) is None
+    assert audiosync.correlate(numpy.ones(100), numpy.random.rand(100)) is None
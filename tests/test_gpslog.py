@@ -0,0 +1,44 @@
+import numpy
+
+import gpslog
+
+def make_log(times, speed):
+    times = numpy.asarray(times, dtype=float)
+    return gpslog.GPSLog("test.nmea", times, numpy.zeros(len(times)),
+        numpy.zeros(len(times)), numpy.asarray(speed, dtype=float))
+
+def test_split_on_stop_and_gap():
+    times = numpy.arange(0, 1000, 1.0)
+    speed = numpy.full(len(times), 20.0)
+    # Stopped in the pits from 200s to 400s.
+    speed[200:400] = 0.0
+    log = make_log(times, speed)
+    # And the logger off from 700s to 800s.
+    keep = (times < 700) | (times >= 800)
+    log = make_log(times[keep], speed[keep])
+
+    sessions = gpslog.split_sessions(log)
+    assert [(s.start_time, s.end_time) for s in sessions] == \
+        [(0.0, 199.0), (400.0, 699.0), (800.0, 999.0)]
+    # Indexes are of the fixes in the log, not counting the gap.
+    assert (sessions[2].start, sessions[2].end) == (700, 900)
+
+def test_short_stop_doesnt_split():
+    times = numpy.arange(0, 300, 1.0)
+    speed = numpy.full(len(times), 20.0)
+    speed[100:130] = 2.0
+    sessions = gpslog.split_sessions(make_log(times, speed))
+    assert len(sessions) == 1
+    assert (sessions[0].start, sessions[0].end) == (0, 300)
+
+def test_short_sessions_ignored():
+    times = numpy.arange(0, 400, 1.0)
+    speed = numpy.zeros(len(times))
+    speed[10:40] = 20.0
+    speed[200:300] = 20.0
+    sessions = gpslog.split_sessions(make_log(times, speed))
+    assert [(s.start, s.end) for s in sessions] == [(200, 300)]
+
+def test_never_moving():
+    times = numpy.arange(0, 100, 1.0)
+    assert gpslog.split_sessions(make_log(times, numpy.zeros(100))) == []
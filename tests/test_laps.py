@@ -0,0 +1,42 @@
+import math
+
+import numpy
+
+import laps
+
+ORIGIN = (51.0, -1.0)
+
+def circle(laps_driven, lap_time=60.0, radius=200.0, rate=10):
+    """Return times, latitude and longitude of driving round a circle
+    starting on its east side."""
+    times = numpy.arange(0, laps_driven * lap_time, 1.0 / rate)
+    angle = 2 * math.pi * times / lap_time
+    (latitude, longitude) = laps.unproject(radius * numpy.cos(angle),
+        radius * numpy.sin(angle), ORIGIN)
+    return (times, latitude, longitude)
+
+# Across the circle's east side, north of where it starts.
+LINE = laps.unproject(numpy.array([180.0, 220.0]), numpy.array([10.0, 10.0]),
+    ORIGIN)
+LINE = (LINE[0][0], LINE[1][0], LINE[0][1], LINE[1][1])
+
+def test_find_crossings():
+    (times, latitude, longitude) = circle(3)
+    crossings = laps.find_crossings(times, latitude, longitude, LINE)
+    # 10 metres round a 200 metre radius circle at a lap every minute.
+    first = 60.0 * 10 / (2 * math.pi * 200)
+    assert len(crossings) == 3
+    assert numpy.allclose(crossings, [first, first + 60, first + 120], atol=0.05)
+
+def test_find_crossings_either_direction():
+    (times, latitude, longitude) = circle(3)
+    crossings = laps.find_crossings(times, latitude[::-1], longitude[::-1], LINE)
+    assert len(crossings) == 3
+
+def test_get_laps():
+    assert laps.get_laps([10.0, 70.0, 131.0]) == [(10.0, 70.0), (70.0, 131.0)]
+    # Noise around the line doesn't count as laps.
+    assert laps.get_laps([10.0, 10.5, 70.0, 75.0, 130.0]) == \
+        [(10.0, 70.0), (70.0, 130.0)]
+    assert laps.get_laps([10.0]) == []
+    assert laps.get_laps([]) == []
@@ -0,0 +1,36 @@
+import matching
+
+def test_align_offset_is_other_minus_tags():
+    tags = [1000, 4000, 9000, 15000]
+    other = [tag + 2500 for tag in tags]
+    match = matching.align(tags, other)
+    assert match.offset == 2500
+    assert match.confidence == 1.0
+    assert match.error == 0.0
+
+    assert matching.align(other, tags).offset == -2500
+
+def test_align_allows_extra_tag():
+    tags = [1000, 4000, 9000, 15000]
+    # A tag registered by the other camera only, and a little jitter.
+    other = [3100, 5000, 6000, 11050, 17000]
+    match = matching.align(tags, other)
+    assert abs(match.offset - 2000) <= 50
+    assert match.confidence == 4 / 5.0
+
+def test_align_needs_enough_tags():
+    assert matching.align([1000], [5000]) is None
+    assert matching.align([], [1000, 2000]) is None
+    # Nothing lines up within the tolerance.
+    assert matching.align([1000, 2000], [5000, 9000]) is None
+
+def test_index_finds_and_forgets():
+    index = matching.SignatureIndex()
+    index.add("a", [1000, 4000, 9000, 15000])
+    index.add("b", [0, 700, 1400])
+    found = dict(index.match([3000, 6000, 11000, 17000]))
+    assert found.keys() == ["a"]
+    assert found["a"].offset == -2000
+
+    index.remove("a")
+    assert list(index.match([3000, 6000, 11000, 17000])) == []
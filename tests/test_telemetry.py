@@ -0,0 +1,37 @@
+import numpy
+
+import telemetry
+
+START = 1500000000.0
+
+def import_log(tmpdir, rows):
+    path = str(tmpdir.join("engine.csv"))
+    with open(path, "w") as f:
+        f.write("Time,RPM,Notes\n")
+        for row in rows:
+            f.write(",".join(str(value) for value in row) + "\n")
+    return telemetry.open_log(path, str(tmpdir.join("telemetry")), START)
+
+def test_resample_interpolates(tmpdir):
+    log = import_log(tmpdir, [(t, 1000 + 100 * t, "") for t in range(10)])
+    rpm = log.resample(["RPM"], START + 1, 4, 8)["RPM"]
+    assert numpy.allclose(rpm, 1100 + 25 * numpy.arange(8))
+
+def test_resample_leaves_gaps_empty(tmpdir):
+    # Switched off from 3s to 10s.
+    times = [0, 1, 2, 3, 10, 11, 12]
+    log = import_log(tmpdir, [(t, 1000, "") for t in times])
+    rpm = log.resample(["RPM"], START, 2, 26)["RPM"]
+    frame_times = numpy.arange(26) / 2.0
+    inside = (frame_times <= 3) | ((frame_times >= 10) & (frame_times <= 12))
+    assert numpy.all(rpm[inside] == 1000)
+    # Past the end of the log as well as in the gap.
+    assert numpy.all(numpy.isnan(rpm[~inside]))
+
+def test_resample_skips_missing_values(tmpdir):
+    # The channel wasn't logged on every row, but the rows are close enough
+    # together to interpolate across.
+    log = import_log(tmpdir, [(0, 1000, ""), (0.5, "", ""), (1, 2000, "x")])
+    assert log.channels() == ["RPM"]
+    rpm = log.resample(["RPM"], START, 4, 5)["RPM"]
+    assert numpy.allclose(rpm, [1000, 1250, 1500, 1750, 2000])
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Thumbnail strips of each video and contact sheets of each session.
+
+A thumbnail is taken every few seconds of each video, decoding only
+keyframes and from the low resolution proxies where there are any, and the
+thumbnails are tiled into a single image per video with an index of their
+times. Contact sheets are HTML pages laying out the thumbnails of every
+camera side by side, lined up using the session offsets, so a whole season
+of sessions can be browsed without decoding any video.
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+import multiprocessing
+import multiprocessing.pool
+
+import numpy
+
+import mp4box
+import proxies
+import seekindex
+import sessionstore
+
+THUMBNAIL_DIR = "thumbnails"
+CONTACT_SHEET_DIR = "contact-sheets"
+
+# Seconds between thumbnails.
+INTERVAL = 10
+
+# Size of each thumbnail in pixels. Videos of other aspect ratios are
+# letterboxed.
+WIDTH = 160
+HEIGHT = 90
+
+# Thumbnails per row of a strip, which keeps long videos well within the
+# 65535 pixel limit on the width of a JPEG.
+COLUMNS = 100
+
+# Bump this whenever the layout of the strips or their indexes changes.
+STRIP_VERSION = 2
+
+def get_strip_path(path, thumbnail_dir=THUMBNAIL_DIR):
+    """Return where the thumbnail strip for the video at path is kept, with
+    its index alongside it in a .json file of the same name."""
+    camera = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    (base, ext) = os.path.splitext(os.path.basename(path))
+    return os.path.join(thumbnail_dir, camera, base + ".jpg")
+
+def get_index_path(strip_path):
+    return os.path.splitext(strip_path)[0] + ".json"
+
+def load_strip_index(path, thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL):
+    """Return the index of the thumbnail strip for the video at path, or None
+    if there isn't a current one."""
+    try:
+        index = json.load(open(get_index_path(get_strip_path(path, thumbnail_dir))))
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if (index.get('version'), index['size'], index['mtime'], index['interval']) != \
+            (STRIP_VERSION, st.st_size, st.st_mtime, interval):
+        return None
+    return index
+
+def get_thumbnail_frames(seek_index, details, interval):
+    """Return (times, decoder options, filter) for taking a thumbnail every
+    interval seconds of a video with the given SeekIndex, which may be None,
+    and details from mp4box.probe_video. times are in milliseconds, and the
+    filter picks out exactly the frames shown at those times by number, so
+    the index always matches the tiles."""
+    if seek_index is not None and len(seek_index.keyframes):
+        # Only decode keyframes, taking the last one before each tick. A
+        # keyframe covering several ticks is only used once.
+        ticks = numpy.arange(0, seek_index.duration(), interval * 1000.0)
+        chosen = numpy.unique(numpy.maximum(numpy.searchsorted(
+            seek_index.keyframe_times_ms, ticks, side="right") - 1, 0))
+        times = [float(t) for t in seek_index.keyframe_times_ms[chosen]]
+        # Only keyframes reach the filter, so n counts keyframes.
+        select = "+".join("eq(n,%d)" % keyframe for keyframe in chosen)
+        return (times, ["-skip_frame", "nokey"], "select='%s'" % select)
+
+    # Without the keyframes every frame has to be decoded.
+    step = max(1, int(round(details['fps'] * interval)))
+    times = [frame * 1000.0 / details['fps']
+        for frame in range(0, details['frames'], step)]
+    return (times, [], "select='not(mod(n,%d))'" % step)
+
+def build_strip(path, source, thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL):
+    """Build the thumbnail strip of the video at path by decoding source,
+    which is either the video or its proxy. Returns True if it succeeded."""
+    details = mp4box.probe_video(source)
+    if details is None:
+        return False
+    duration = details['duration'] * 1000
+    (times, decoder_options, frame_filter) = get_thumbnail_frames(
+        seekindex.get_seek_index(source), details, interval)
+    if not times:
+        return False
+    columns = min(len(times), COLUMNS)
+    rows = (len(times) + columns - 1) // columns
+
+    strip_path = get_strip_path(path, thumbnail_dir)
+    if not os.path.isdir(os.path.dirname(strip_path)):
+        try:
+            os.makedirs(os.path.dirname(strip_path))
+        except OSError:
+            # Another worker may have just created it.
+            pass
+
+    # Write to a temporary file first, so an interrupted job isn't mistaken
+    # for a current strip.
+    partial_path = strip_path + ".partial.jpg"
+    filters = ",".join([
+        frame_filter,
+        # Logs each frame selected, so they can be counted.
+        "showinfo",
+        "scale=%d:%d:force_original_aspect_ratio=decrease" % (WIDTH, HEIGHT),
+        "pad=%d:%d:(ow-iw)/2:(oh-ih)/2" % (WIDTH, HEIGHT),
+        "tile=%dx%d" % (columns, rows),
+    ])
+    process = subprocess.Popen(["ffmpeg", "-v", "info", "-nostats", "-y",
+        "-nostdin"] + decoder_options + ["-i", source, "-an", "-vf", filters,
+        "-frames:v", "1", "-q:v", "5", partial_path], stderr=subprocess.PIPE)
+    log = process.communicate()[1]
+    tiles = len(re.findall(r"Parsed_showinfo.*\bn:\s*\d+", log))
+    if process.returncode != 0 or tiles != len(times):
+        if process.returncode != 0:
+            # The error comes after any frames showinfo logged.
+            print >> sys.stderr, "%s: %s" % (source,
+                (log.strip().splitlines() or [""])[-1])
+        else:
+            print >> sys.stderr, "%s: expected %d thumbnails, got %d" % (
+                source, len(times), tiles)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return False
+    os.rename(partial_path, strip_path)
+
+    st = os.stat(path)
+    index = {
+        "version": STRIP_VERSION,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "interval": interval,
+        "duration": duration,
+        "times": times,
+        "columns": columns,
+        "strip": os.path.basename(strip_path),
+    }
+    open(get_index_path(strip_path), "w").write(json.dumps(index))
+    return True
+
+def build_strips(sessions, thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL, jobs=None):
+    """Build the thumbnail strips for every video in sessions which doesn't
+    already have a current one, running up to jobs ffmpeg processes at once.
+    Returns the number of strips built."""
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    missing = []
+    for session in sessions:
+        sources = proxies.use_proxies(session)
+        for (camera, view) in session['views'].items():
+            for (path, source) in zip(view['paths'], sources['views'][camera]['paths']):
+                if load_strip_index(path, thumbnail_dir, interval) is None:
+                    missing.append((path, source))
+    print "Building %d thumbnail strips, %d at a time." % (len(missing), jobs)
+
+    def worker(job):
+        (path, source) = job
+        return (path, build_strip(path, source, thumbnail_dir, interval))
+
+    # The work is done by ffmpeg, so threads are enough to keep the pool of
+    # processes busy.
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    built = 0
+    try:
+        for (path, ok) in pool.imap_unordered(worker, missing):
+            if ok:
+                built += 1
+            else:
+                print >> sys.stderr, "%s: couldn't build thumbnails" % path
+    finally:
+        pool.close()
+        pool.join()
+
+    return built
+
+def get_view_thumbnails(view, thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL):
+    """Return a list of (start, end, strip_path, times, columns) tuples for
+    the videos of view, where start and end are when each video starts and ends
+    within the view in milliseconds. Any videos after one without thumbnails
+    are left out, as where they start isn't known."""
+    chapters = []
+    start = 0.0
+    for path in view['paths']:
+        index = load_strip_index(path, thumbnail_dir, interval)
+        if index is None:
+            break
+        end = start + index['duration']
+        chapters.append((start, end, get_strip_path(path, thumbnail_dir),
+            index['times'], index['columns']))
+        start = end
+    return chapters
+
+def find_thumbnail(chapters, ms):
+    """Return (strip_path, column, row) of the thumbnail showing ms into a
+    view, or None if it's outside the view."""
+    for (start, end, strip_path, times, columns) in chapters:
+        if start <= ms < end:
+            tile = int(max(numpy.searchsorted(times, ms - start, side="right") - 1, 0))
+            return (strip_path, tile % columns, tile // columns)
+    return None
+
+SHEET_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; }}
+td {{ padding: 1px; }}
+.thumb {{ width: {width}px; height: {height}px; background-color: #000; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<table>
+<tr><th></th>{headings}</tr>
+{rows}
+</table>
+</body>
+</html>
+"""
+
+def make_contact_sheet(title, session, cameras, sheet_dir,
+        thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL):
+    """Return an HTML contact sheet of session, with a row every interval
+    seconds and a column for each of cameras, lined up using the offsets."""
+    views = {}
+    for camera in cameras:
+        if camera in session['views']:
+            view = session['views'][camera]
+            views[camera] = (view.get('offset', 0),
+                get_view_thumbnails(view, thumbnail_dir, interval))
+
+    # The session lasts for as long as any view has video.
+    length = 0
+    for (offset, chapters) in views.values():
+        if chapters:
+            length = max(length, chapters[-1][1] - offset)
+
+    rows = []
+    for position in range(0, int(length), interval * 1000):
+        cells = []
+        for camera in cameras:
+            found = None
+            if camera in views:
+                (offset, chapters) = views[camera]
+                found = find_thumbnail(chapters, position + offset)
+
+            if found is None:
+                cells.append('<td><div class="thumb"></div></td>')
+            else:
+                (strip_path, column, row) = found
+                cells.append('<td><div class="thumb" style="background: '
+                    'url(\'%s\') -%dpx -%dpx"></div></td>' % (
+                    os.path.relpath(strip_path, sheet_dir), column * WIDTH,
+                    row * HEIGHT))
+
+        seconds = position // 1000
+        rows.append("<tr><td>%d:%02d</td>%s</tr>" % (seconds // 60,
+            seconds % 60, "".join(cells)))
+
+    return SHEET_TEMPLATE.format(title=title, width=WIDTH, height=HEIGHT,
+        headings="".join("<th>%s</th>" % camera for camera in cameras),
+        rows="\n".join(rows))
+
+def write_contact_sheets(sessions, layout, sheet_dir=CONTACT_SHEET_DIR,
+        thumbnail_dir=THUMBNAIL_DIR, interval=INTERVAL):
+    """Write a contact sheet for each of sessions, a list of (index, session)
+    tuples, and an index page linking to them."""
+    if not os.path.isdir(sheet_dir):
+        os.makedirs(sheet_dir)
+
+    links = []
+    for (index, session) in sessions:
+        name = "session-%d" % index
+        html = make_contact_sheet(name, session, layout, sheet_dir,
+            thumbnail_dir, interval)
+        open(os.path.join(sheet_dir, name + ".html"), "w").write(html)
+        links.append('<li><a href="%s.html">%s</a></li>' % (name, name))
+
+    open(os.path.join(sheet_dir, "index.html"), "w").write(
+        "<!DOCTYPE html>\n<html><body><ul>\n%s\n</ul></body></html>\n" %
+        "\n".join(links))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", action="store", default="sessions.yaml")
+    parser.add_argument("--index", action="append", type=int, default=[],
+        help="Only do this session. May be given more than once, defaults to "
+        "every session.")
+    parser.add_argument("--layout", action="store", default="front:inside:back")
+    parser.add_argument("--interval", action="store", type=int, default=INTERVAL,
+        help="Seconds between thumbnails.")
+    parser.add_argument("--thumbnail-dir", action="store", default=THUMBNAIL_DIR)
+    parser.add_argument("--output-dir", action="store", default=CONTACT_SHEET_DIR)
+    parser.add_argument("--jobs", action="store", type=int, default=None)
+    args = parser.parse_args()
+
+    store = sessionstore.open_sessions(args.path)
+    indexes = args.index or range(len(store))
+    sessions = [(index, store[index]) for index in indexes]
+
+    build_strips([session for (index, session) in sessions], args.thumbnail_dir,
+        args.interval, args.jobs)
+    write_contact_sheets(sessions, args.layout.split(":"), args.output_dir,
+        args.thumbnail_dir, args.interval)
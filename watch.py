@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Keep sessions.yaml up to date as videos are copied into the camera
+directories.
+
+Each camera directory is polled for new files. Once a file has stopped
+growing it's ingested into the existing segments, and only the sessions it
+could affect are matched and rebuilt again.
+"""
+
+import os
+import sys
+import time
+import struct
+import argparse
+
+import yaml
+
+import assemble
+import audiosync
+import matching
+import metacache
+import profiling
+import proxies
+import sessionstore
+
+# Seconds between looking for new files.
+POLL_INTERVAL = 2.0
+
+# Seconds a file's size and mtime have to stay the same before it's treated
+# as completely copied.
+SETTLE_TIME = 5.0
+
+def get_version(path):
+    """Return the (size, mtime) of the file at path, or None if it's gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+class Watcher(object):
+    def __init__(self, camera_paths, cache, corrections, yaml_path,
+            jobs=1, jobs_per_device=1, audio_sync=False,
+            audio_seconds=audiosync.MAX_SECONDS, settle_time=SETTLE_TIME,
+            keep_duplicates=False, proxy_dir=proxies.PROXY_DIR):
+        self.camera_paths = camera_paths
+        self.cache = cache
+        self.corrections = corrections
+        self.yaml_path = yaml_path
+        self.jobs = jobs
+        self.jobs_per_device = jobs_per_device
+        self.audio_sync = audio_sync
+        self.audio_seconds = audio_seconds
+        self.settle_time = settle_time
+        self.keep_duplicates = keep_duplicates
+        self.proxy_dir = proxy_dir
+
+        self.segments = assemble.SegmentCatalog()
+        self.index = matching.SignatureIndex()
+
+        # Files seen but not yet ingested, mapped to their last (size, mtime)
+        # and when that was first seen, or None if the file couldn't be read
+        # and won't be tried again until it changes.
+        self.pending = {}
+        # Ingested files mapped to the (size, mtime) they were ingested at,
+        # and their segments.
+        self.ingested = {}
+        self.segment_of = {}
+        self.fingerprints = {}
+
+        # Each session's reference segment is mapped to its members and
+        # session dict, and every member to its reference segment.
+        self.groups = {}
+        self.group_of = {}
+        self.sessions = []
+
+    def poll(self):
+        """Return a list of (path, camera) tuples for new files which have
+        finished being copied."""
+        now = time.time()
+        ready = []
+        # Every file found this time, so that pending files which disappear
+        # before they settle, such as by being renamed, are forgotten.
+        listed = set()
+        for camera_path in self.camera_paths:
+            camera = os.path.basename(camera_path)
+            try:
+                filenames = os.listdir(camera_path)
+            except OSError:
+                # The directory may not have been created yet.
+                continue
+
+            for filename in filenames:
+                if not filename.endswith(".MP4"):
+                    continue
+                path = os.path.join(camera_path, filename)
+                version = get_version(path)
+                if version is None or self.ingested.get(path) == version:
+                    # Gone already, or unchanged since it was ingested. A
+                    # file which changes after being ingested, such as one
+                    # whose copy stalled for a while, is ingested again.
+                    continue
+                listed.add(path)
+
+                if path not in self.pending or self.pending[path][0] != version:
+                    self.pending[path] = (version, now)
+                elif self.pending[path][1] is None:
+                    # Couldn't be read, and hasn't changed since.
+                    continue
+                elif now - self.pending[path][1] >= self.settle_time:
+                    del self.pending[path]
+                    ready.append((path, camera))
+
+        for path in set(self.pending) - listed:
+            del self.pending[path]
+
+        return ready
+
+    def get_affected(self, new_segments):
+        """Return the set of root segments whose sessions may change with the
+        addition of new_segments."""
+        affected = set()
+        for segment in new_segments:
+            if segment.is_root_segment():
+                affected.add(segment)
+                # Anything the new segment can be lined up with may now
+                # choose it as its best match.
+                for (other, match) in self.index.match(segment.tags):
+                    affected.add(other)
+            else:
+                # A new chapter only changes the paths of its series.
+                root = self.segments.get_root(segment)
+                if root is not None:
+                    affected.add(root)
+
+        # Whole sessions are matched again, along with the sessions of any
+        # segments the user has forced a match with.
+        filenames = set(segment.filename for segment in affected)
+        for correction in self.corrections:
+            if correction['action'] != "forcematch":
+                continue
+            pair = correction['filenames'].split(" ")
+            if filenames.intersection(pair):
+                for filename in pair:
+                    if filename in self.segments.by_filename:
+                        affected.add(self.segments.by_filename[filename])
+
+        for segment in list(affected):
+            if segment in self.group_of:
+                affected.update(self.groups[self.group_of[segment]][0])
+
+        return affected
+
+    def rematch(self, affected):
+        """Match the affected root segments against each other from scratch.
+        Returns them in the order they were ingested."""
+        roots = [segment for segment in self.segments.root_segments()
+            if segment in affected]
+
+        for segment in roots:
+            segment.matched.clear()
+            segment.forced_offsets.clear()
+
+        # Segments outside the affected sessions either can't be lined up
+        # with these or already lost out to a match within them, so an index
+        # of just these gives the same matches as the full index would.
+        index = matching.SignatureIndex()
+        for segment in roots:
+            index.add(segment, segment.tags)
+        for segment in roots:
+            segment.find_other_camera_segments(index)
+
+        filenames = set(segment.filename for segment in roots)
+        corrections = [correction for correction in self.corrections
+            if correction['action'] == "forcematch" and
+            filenames.issuperset(correction['filenames'].split(" "))]
+        assemble.apply_corrections(self.segments, corrections)
+
+        return roots
+
+    def load_metadata(self, files):
+        """Return a dict of metadata for each of files which can be read.
+        Files which can't, such as truncated ones, are reported and left
+        pending until they change."""
+        paths = [path for (path, camera) in files]
+        try:
+            return assemble.load_metadata(paths, self.cache, self.jobs,
+                self.jobs_per_device)
+        except (IOError, OSError, struct.error):
+            pass
+
+        # Find out which files are the problem, one at a time.
+        metadata = {}
+        for path in paths:
+            try:
+                metadata.update(assemble.load_metadata([path], self.cache))
+            except (IOError, OSError, struct.error) as ex:
+                print >> sys.stderr, "%s: couldn't read it, waiting for it to " \
+                    "change: %s" % (path, ex)
+                self.pending[path] = (get_version(path), None)
+        return metadata
+
+    def remove(self, path):
+        """Drop the segment of path, which is about to be ingested again.
+        Returns the segments whose sessions it was part of."""
+        old = self.segment_of.pop(path)
+        root = self.segments.get_root(old) or old
+        members = set([root])
+        if root in self.group_of:
+            members.update(self.groups[self.group_of[root]][0])
+
+        self.segments.remove(old)
+        self.index.remove(old)
+        for segment in members:
+            reference = self.group_of.pop(segment, None)
+            self.groups.pop(reference, None)
+        members.discard(old)
+        return members
+
+    def ingest(self, files):
+        """Add files to the segments, replacing those of any which have
+        changed since they were ingested, and rebuild the sessions they
+        affect. Returns the number of sessions changed."""
+        versions = {}
+        for (path, camera) in files:
+            versions[path] = get_version(path)
+        files = [(path, camera) for (path, camera) in files
+            if versions[path] is not None]
+
+        # A changed file mustn't be taken for a copy of what it used to be.
+        paths = set(path for (path, camera) in files)
+        for (fingerprint, path) in self.fingerprints.items():
+            if path in paths:
+                del self.fingerprints[fingerprint]
+
+        unique = assemble.remove_duplicates(files, self.cache, self.fingerprints,
+            self.keep_duplicates)
+        replaced = set()
+        for (path, camera) in files:
+            if (path, camera) not in unique:
+                self.ingested[path] = versions[path]
+                if path in self.segment_of:
+                    replaced.update(self.remove(path))
+
+        metadata = self.load_metadata(unique)
+        self.cache.save()
+
+        new_segments = []
+        for (path, camera) in unique:
+            if path not in metadata:
+                continue
+            if path in self.segment_of:
+                replaced.update(self.remove(path))
+            segment = assemble.Segment(path, camera, metadata=metadata[path])
+            self.segments.add(segment)
+            self.segments.link(segment)
+            self.segment_of[path] = segment
+            self.ingested[path] = versions[path]
+            new_segments.append(segment)
+
+        affected = self.get_affected(new_segments) | replaced
+        for segment in new_segments:
+            if segment.is_root_segment():
+                self.index.add(segment, segment.tags)
+
+        for segment in affected:
+            reference = self.group_of.pop(segment, None)
+            self.groups.pop(reference, None)
+
+        roots = self.rematch(affected)
+        for (reference, members) in assemble.get_session_groups(roots):
+            session = assemble.build_session(reference, members,
+                self.audio_sync, self.audio_seconds)
+            proxies.add_proxy_paths(session, self.proxy_dir)
+            self.groups[reference] = (members, session)
+            for segment in members:
+                self.group_of[segment] = reference
+
+        # Sessions which weren't rebuilt are the same objects as before, so
+        # only those which are new or have moved need writing to the store.
+        previous = self.sessions
+        self.sessions = sorted((session for (members, session) in self.groups.values()),
+            key=assemble.get_session_sort_key)
+        changed = [index for (index, session) in enumerate(self.sessions)
+            if index >= len(previous) or previous[index] is not session]
+
+        with profiling.stage("yaml_write"):
+            sessionstore.update_sessions(self.sessions, changed, self.yaml_path)
+        return len(changed)
+
+    def run(self, interval=POLL_INTERVAL):
+        while True:
+            files = self.poll()
+            if files:
+                start = time.time()
+                changed = self.ingest(files)
+                print "Ingested %d files, updated %d of %d sessions in %.1fs" % (
+                    len(files), changed, len(self.sessions), time.time() - start)
+                sys.stdout.flush()
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("camera_paths", nargs="+")
+    parser.add_argument("--cache", action="store", default="metadata-cache.sqlite")
+    parser.add_argument("--jobs", action="store", type=int, default=4)
+    parser.add_argument("--jobs-per-device", action="store", type=int, default=1)
+    parser.add_argument("--proxy-dir", action="store", default=proxies.PROXY_DIR)
+    parser.add_argument("--audio-sync", action="store_true", default=False)
+    parser.add_argument("--audio-seconds", action="store", type=int,
+        default=audiosync.MAX_SECONDS)
+    parser.add_argument("--interval", action="store", type=float,
+        default=POLL_INTERVAL, help="Seconds between looking for new files.")
+    parser.add_argument("--settle-time", action="store", type=float,
+        default=SETTLE_TIME,
+        help="Seconds a file must stop changing for before it's ingested.")
+    parser.add_argument("--keep-duplicates", action="store_true", default=False,
+        help="Only warn about copies of the same file, rather than ignoring "
+        "all but the first.")
+    args = parser.parse_args()
+
+    corrections = yaml.load(open("corrections.yaml").read()) or []
+    watcher = Watcher(args.camera_paths, metacache.MetadataCache(args.cache),
+        corrections, "sessions.yaml", args.jobs, args.jobs_per_device,
+        args.audio_sync, args.audio_seconds, args.settle_time,
+        args.keep_duplicates, args.proxy_dir)
+
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass